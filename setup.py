@@ -23,6 +23,14 @@ setuptools.setup(
         'requests>=2.23.0',
         'troposphere>=2.7.1',
     ],
+    extras_require={
+        'zstd': ['zstandard>=0.15.0'],
+        'brotli': ['brotli>=1.0.9'],
+        'ijson': ['ijson>=3.1'],
+        'msgpack': ['msgpack>=1.0.0'],
+        'cbor': ['cbor2>=5.2.0'],
+        'all': ['zstandard>=0.15.0', 'brotli>=1.0.9', 'ijson>=3.1', 'msgpack>=1.0.0', 'cbor2>=5.2.0'],
+    },
     data_files=[('firefly_aws_config', ['firefly.yml'])],
     packages=setuptools.PEP420PackageFinder.find('src'),
     package_dir={'': 'src'},
@@ -11,7 +11,9 @@
 #
 #  You should have received a copy of the GNU General Public License along with Firefly. If not, see
 #  <http://www.gnu.org/licenses/>.
+from .deadline import Deadline, DeadlineAware
 from .entity import *
 from .error import *
 from .resource_name_aware import ResourceNameAware
+from .retry import jittered_backoff, retry_with_jitter
 from .service import *
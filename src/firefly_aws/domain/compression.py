@@ -0,0 +1,104 @@
+#  Copyright (c) 2020 JD Williams
+#
+#  This file is part of Firefly, a Python SOA framework built by JD Williams. Firefly is free software; you can
+#  redistribute it and/or modify it under the terms of the GNU General Public License as published by the
+#  Free Software Foundation; either version 3 of the License, or (at your option) any later version.
+#
+#  Firefly is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the
+#  implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+#  Public License for more details. You should have received a copy of the GNU Lesser General Public
+#  License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  You should have received a copy of the GNU General Public License along with Firefly. If not, see
+#  <http://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+
+import bz2
+import gzip
+from typing import Optional, BinaryIO
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP = 'gzip'
+BZ2 = 'bz2'
+ZSTD = 'zstd'
+NONE = 'none'
+# Consumers deployed before payload compression can only read plain JSON under a .json key, so payloads are left
+# uncompressed (and never inlined) unless PAYLOAD_CODEC is set. Set it once every consumer has been upgraded.
+DEFAULT_CODEC = NONE
+
+EXTENSIONS = {
+    GZIP: 'gz',
+    BZ2: 'bz2',
+    ZSTD: 'zst',
+}
+
+DEFAULT_LEVELS = {
+    GZIP: 6,
+    BZ2: 9,
+    ZSTD: 3,
+}
+
+
+def compress(data: bytes, codec: str, level: int = None) -> bytes:
+    level = DEFAULT_LEVELS.get(codec) if level is None else level
+    if codec == GZIP:
+        return gzip.compress(data, compresslevel=level)
+    if codec == BZ2:
+        return bz2.compress(data, compresslevel=level)
+    if codec == ZSTD:
+        _require_zstandard()
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    if codec == NONE:
+        return data
+    raise ValueError(f'Unsupported compression codec: {codec}')
+
+
+def decompress(data: bytes, codec: str) -> bytes:
+    if codec == GZIP:
+        return gzip.decompress(data)
+    if codec == BZ2:
+        return bz2.decompress(data)
+    if codec == ZSTD:
+        _require_zstandard()
+        # Frames written by ZstdCompressor.compress() carry their content size, but streamed ones may not.
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    if codec == NONE:
+        return data
+    raise ValueError(f'Unsupported compression codec: {codec}')
+
+
+def open_stream(fileobj: BinaryIO, codec: Optional[str]) -> BinaryIO:
+    """
+    Wraps a readable binary stream so it is decompressed incrementally as it's read.
+    """
+    if codec == GZIP:
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+    if codec == BZ2:
+        return bz2.BZ2File(fileobj, mode='rb')
+    if codec == ZSTD:
+        _require_zstandard()
+        return zstandard.ZstdDecompressor().stream_reader(fileobj)
+    if codec is None or codec == NONE:
+        return fileobj
+    raise ValueError(f'Unsupported compression codec: {codec}')
+
+
+def codec_for_key(key: str) -> Optional[str]:
+    for codec, extension in EXTENSIONS.items():
+        if key.endswith(f'.{extension}'):
+            return codec
+    return None
+
+
+def key_suffix(codec: str) -> str:
+    return f'.{EXTENSIONS[codec]}' if codec in EXTENSIONS else ''
+
+
+def _require_zstandard():
+    if zstandard is None:
+        raise ImportError('The zstandard package is required for zstd compression (pip install firefly-aws[zstd])')
@@ -0,0 +1,62 @@
+#  Copyright (c) 2020 JD Williams
+#
+#  This file is part of Firefly, a Python SOA framework built by JD Williams. Firefly is free software; you can
+#  redistribute it and/or modify it under the terms of the GNU General Public License as published by the
+#  Free Software Foundation; either version 3 of the License, or (at your option) any later version.
+#
+#  Firefly is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the
+#  implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+#  Public License for more details. You should have received a copy of the GNU Lesser General Public
+#  License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  You should have received a copy of the GNU General Public License along with Firefly. If not, see
+#  <http://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+
+from abc import ABC
+from time import monotonic
+from typing import Optional
+
+import firefly as ff
+
+from .error import LambdaTimedOut
+
+
+class Deadline:
+    def __init__(self, remaining_millis: float):
+        self._expires_at = monotonic() + (remaining_millis / 1000)
+
+    def remaining_millis(self) -> int:
+        return max(0, int((self._expires_at - monotonic()) * 1000))
+
+    def remaining_seconds(self) -> float:
+        return max(0.0, self._expires_at - monotonic())
+
+    def expired(self) -> bool:
+        return monotonic() >= self._expires_at
+
+    def has_time_for(self, millis: int) -> bool:
+        return self.remaining_millis() > millis
+
+    def check(self, millis: int = 0):
+        if not self.has_time_for(millis):
+            raise LambdaTimedOut(f'Deadline reached ({self.remaining_millis()}ms remaining)')
+
+
+class DeadlineAware(ABC):
+    _kernel: ff.Kernel = None
+
+    def _deadline(self) -> Optional[Deadline]:
+        if self._kernel is None:
+            return None
+        return getattr(self._kernel, 'deadline', None)
+
+    def _check_deadline(self, millis: int = 0):
+        deadline = self._deadline()
+        if deadline is not None:
+            deadline.check(millis)
+
+    def _has_time_for(self, millis: int) -> bool:
+        deadline = self._deadline()
+        return deadline is None or deadline.has_time_for(millis)
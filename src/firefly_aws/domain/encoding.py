@@ -0,0 +1,148 @@
+#  Copyright (c) 2020 JD Williams
+#
+#  This file is part of Firefly, a Python SOA framework built by JD Williams. Firefly is free software; you can
+#  redistribute it and/or modify it under the terms of the GNU General Public License as published by the
+#  Free Software Foundation; either version 3 of the License, or (at your option) any later version.
+#
+#  Firefly is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the
+#  implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+#  Public License for more details. You should have received a copy of the GNU Lesser General Public
+#  License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  You should have received a copy of the GNU General Public License along with Firefly. If not, see
+#  <http://www.gnu.org/licenses/>.
+from __future__ import annotations
+
+from datetime import datetime, date
+from decimal import Decimal
+from typing import Optional, Tuple
+
+from . import compression
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+JSON = 'json'
+MSGPACK = 'msgpack'
+CBOR = 'cbor'
+
+EXTENSIONS = {
+    JSON: 'json',
+    MSGPACK: 'msgpack',
+    CBOR: 'cbor',
+}
+
+# msgpack extension types and a CBOR tag for values the formats can't represent as-is (CBOR only has timezone-aware
+# datetimes). Decoding them straight back to datetime/date/Decimal spares from_dict() from parsing strings.
+_DATETIME = 1
+_DATE = 2
+_DECIMAL = 3
+_CBOR_NAIVE_DATETIME_TAG = 55001
+
+
+def parse_codec(codec: str) -> Tuple[str, str]:
+    """
+    Splits a codec spec such as "msgpack+zstd" into its format and compression.
+    """
+    fmt, _, compression_codec = codec.partition('+')
+    if fmt not in EXTENSIONS:
+        raise ValueError(f'Unsupported encoding: {fmt}')
+    compression_codec = compression_codec or compression.NONE
+    if compression_codec != compression.NONE and compression_codec not in compression.EXTENSIONS:
+        raise ValueError(f'Unsupported compression codec: {compression_codec}')
+    return fmt, compression_codec
+
+
+def encode(data: dict, fmt: str) -> bytes:
+    if fmt == MSGPACK:
+        _require(msgpack, 'msgpack', 'msgpack')
+        return msgpack.packb(data, default=_msgpack_default, use_bin_type=True)
+    if fmt == CBOR:
+        _require(cbor2, 'cbor2', 'cbor')
+        return cbor2.dumps(_tag_naive_datetimes(data), default=_cbor_default)
+    raise ValueError(f'Unsupported encoding: {fmt}')
+
+
+def decode(data: bytes, fmt: str) -> dict:
+    if fmt == MSGPACK:
+        _require(msgpack, 'msgpack', 'msgpack')
+        return msgpack.unpackb(data, ext_hook=_msgpack_ext_hook, raw=False, strict_map_key=False)
+    if fmt == CBOR:
+        _require(cbor2, 'cbor2', 'cbor')
+        return cbor2.loads(data, tag_hook=_cbor_tag_hook)
+    raise ValueError(f'Unsupported encoding: {fmt}')
+
+
+def key_suffix(fmt: str, compression_codec: str = compression.NONE) -> str:
+    return f'.{EXTENSIONS[fmt]}{compression.key_suffix(compression_codec)}'
+
+
+def codec_for_key(key: str) -> Optional[Tuple[str, str]]:
+    """
+    Detects the format and compression of an object from its key suffix, e.g. "x.msgpack.zst".
+    """
+    compression_codec = compression.codec_for_key(key) or compression.NONE
+    key = key[:len(key) - len(compression.key_suffix(compression_codec))]
+    for fmt, extension in EXTENSIONS.items():
+        if key.endswith(f'.{extension}'):
+            return fmt, compression_codec
+    return None
+
+
+def _msgpack_default(value):
+    if isinstance(value, datetime):
+        return msgpack.ExtType(_DATETIME, value.isoformat().encode('utf-8'))
+    if isinstance(value, date):
+        return msgpack.ExtType(_DATE, value.isoformat().encode('utf-8'))
+    if isinstance(value, Decimal):
+        return msgpack.ExtType(_DECIMAL, str(value).encode('utf-8'))
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f'Cannot encode {type(value).__name__} with msgpack')
+
+
+def _msgpack_ext_hook(code: int, data: bytes):
+    if code == _DATETIME:
+        return datetime.fromisoformat(data.decode('utf-8'))
+    if code == _DATE:
+        return date.fromisoformat(data.decode('utf-8'))
+    if code == _DECIMAL:
+        return Decimal(data.decode('utf-8'))
+    return msgpack.ExtType(code, data)
+
+
+def _tag_naive_datetimes(value):
+    if isinstance(value, dict):
+        return {k: _tag_naive_datetimes(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_tag_naive_datetimes(v) for v in value]
+    if isinstance(value, datetime) and value.tzinfo is None:
+        return cbor2.CBORTag(_CBOR_NAIVE_DATETIME_TAG, value.isoformat())
+    return value
+
+
+def _cbor_default(encoder, value):
+    if isinstance(value, (set, frozenset)):
+        encoder.encode(list(value))
+    else:
+        raise TypeError(f'Cannot encode {type(value).__name__} with cbor')
+
+
+def _cbor_tag_hook(first, second):
+    # cbor2 5.x passes (decoder, tag), 6.x passes (tag, immutable).
+    tag = first if isinstance(first, cbor2.CBORTag) else second
+    if tag.tag == _CBOR_NAIVE_DATETIME_TAG:
+        return datetime.fromisoformat(tag.value)
+    return tag
+
+
+def _require(module, name: str, extra: str):
+    if module is None:
+        raise ImportError(f'The {name} package is required for {extra} encoding (pip install firefly-aws[{extra}])')
@@ -21,6 +21,9 @@ class ResourceNameAware(ABC):
     def _queue_name(self, context: str):
         return f'{self._service_name(context)}Queue'
 
+    def _queue_url(self, context: str):
+        return f'https://sqs.{self._region}.amazonaws.com/{self._account_id}/{self._queue_name(context)}'
+
     def _ddb_resource_name(self, name: str):
         return f'{self._service_name(name)}DdbTable'
 
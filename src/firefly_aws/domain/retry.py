@@ -0,0 +1,39 @@
+#  Copyright (c) 2020 JD Williams
+#
+#  This file is part of Firefly, a Python SOA framework built by JD Williams. Firefly is free software; you can
+#  redistribute it and/or modify it under the terms of the GNU General Public License as published by the
+#  Free Software Foundation; either version 3 of the License, or (at your option) any later version.
+#
+#  Firefly is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the
+#  implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+#  Public License for more details. You should have received a copy of the GNU Lesser General Public
+#  License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  You should have received a copy of the GNU General Public License along with Firefly. If not, see
+#  <http://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+
+import random
+from time import sleep
+from typing import Callable
+
+
+def jittered_backoff(attempt: int, base: float = .1, cap: float = 5.) -> float:
+    """
+    "Full jitter" backoff: a random wait between 0 and the capped exponential delay for this attempt.
+    """
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def retry_with_jitter(cb: Callable, retries: int = 5, base: float = .1, cap: float = 5., catch=Exception,
+                      should_retry: Callable = None):
+    attempt = 0
+    while True:
+        try:
+            return cb()
+        except catch as e:
+            attempt += 1
+            if attempt >= retries or (should_retry is not None and not should_retry(e)):
+                raise e
+            sleep(jittered_backoff(attempt, base=base, cap=cap))
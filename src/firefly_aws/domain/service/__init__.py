@@ -15,7 +15,8 @@
 from .handle_error import HandleError
 from .jwt_decoder import JwtDecoder
 from .lambda_executor import LambdaExecutor
-from .load_payload import LoadPayload
+from .load_payload import LoadPayload, PayloadHandle
+from .outbox import Outbox
 from .prepare_s3_download import PrepareS3Download
 from .s3_service import S3Service
 from .store_large_payloads_in_s3 import StoreLargePayloadsInS3
@@ -16,19 +16,26 @@ from __future__ import annotations
 
 import base64
 import bz2
+import gzip
 import inspect
 import io
 import json
-import math
 import os
 import re
 import signal
+import threading
 from contextlib import contextmanager
-from typing import Union
+from itertools import chain
+from typing import Union, Iterator, Optional
 
 import firefly as ff
 from multipart import MultipartParser
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 import firefly_aws.domain as domain
 
 
@@ -48,6 +55,20 @@ ACCESS_CONTROL_HEADERS = {
     'Access-Control-Expose-Headers': '*',
 }
 
+# Synchronous Lambda responses are capped at 6 MB, including the JSON envelope API Gateway receives.
+LAMBDA_RESPONSE_LIMIT = 6 * 1024 * 1024
+RESPONSE_ENVELOPE_ALLOWANCE = 16 * 1024
+MAX_RESPONSE_BODY_SIZE = LAMBDA_RESPONSE_LIMIT - RESPONSE_ENVELOPE_ALLOWANCE
+DEFAULT_COMPRESSION_THRESHOLD = 8 * 1024
+DEFAULT_MAX_COMPRESSIBLE_BODY_SIZE = 32 * 1024 * 1024
+DEFAULT_MULTIPART_MEMFILE_LIMIT = 1024 * 1024
+DEFAULT_MULTIPART_MEM_LIMIT = 16 * 1024 * 1024
+# Time kept back from the Lambda timeout for reporting errors: 10% of it, but at least a second.
+HARD_LIMIT_RESERVE = .1
+MIN_HARD_LIMIT_RESERVE_MILLIS = 1000
+DEADLINE_RATIO = .9
+JSON_CHUNK_SIZE = 1000
+
 COGNITO_TRIGGERS = (
     'PreSignUp_SignUp', 'PreSignUp_AdminCreateUser', 'PostConfirmation_ConfirmSignUp',
     'PostConfirmation_ConfirmForgotPassword', 'PreAuthentication_Authentication', 'PostAuthentication_Authentication',
@@ -61,15 +82,71 @@ COGNITO_TRIGGERS = (
 
 
 @contextmanager
-def time_limit(seconds):
+def time_limit(seconds: float):
+    # Signals can only be handled in the main thread. Elsewhere we rely on the kernel's deadline alone.
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
     def signal_handler(signum, frame):
         raise domain.LambdaTimedOut('Time limit exceeded')
     signal.signal(signal.SIGALRM, signal_handler)
-    signal.alarm(seconds)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
     try:
         yield
     finally:
-        signal.alarm(0)
+        signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+class Base64Reader(io.RawIOBase):
+    """
+    Decodes a base64 string incrementally, so the decoded body never exists in memory as a whole.
+    """
+    def __init__(self, data: str, block_size: int = 64 * 1024):
+        self._data = data
+        self._position = 0
+        self._block_size = block_size - (block_size % 4)
+        self._buffer = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while len(self._buffer) < len(b) and self._position < len(self._data):
+            block = self._data[self._position:self._position + self._block_size]
+            self._position += self._block_size
+            self._buffer += base64.b64decode(block)
+
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+
+        return n
+
+
+def iter_json(serializer: ff.Serializer, data: any) -> Iterator[str]:
+    """
+    Serialize data in chunks. Lists (top-level, or values of a top-level dict) are serialized JSON_CHUNK_SIZE items
+    at a time, so large collections can be consumed without building the whole document in memory.
+    """
+    if isinstance(data, (list, tuple)):
+        yield '['
+        for i in range(0, len(data), JSON_CHUNK_SIZE):
+            if i > 0:
+                yield ','
+            yield serializer.serialize(data[i:i + JSON_CHUNK_SIZE])[1:-1]
+        yield ']'
+    elif isinstance(data, dict) and all(isinstance(k, str) for k in data.keys()):
+        yield '{'
+        for i, (k, v) in enumerate(data.items()):
+            yield f'{"," if i > 0 else ""}{json.dumps(k)}:'
+            if isinstance(v, (list, tuple)):
+                yield from iter_json(serializer, v)
+            else:
+                yield serializer.serialize(v)
+        yield '}'
+    else:
+        yield serializer.serialize(data)
 
 
 class LambdaExecutor(ff.DomainService):
@@ -83,6 +160,10 @@ class LambdaExecutor(ff.DomainService):
     _handle_error: domain.HandleError = None
     _store_large_payloads_in_s3: domain.StoreLargePayloadsInS3 = None
     _load_payload: domain.LoadPayload = None
+    _message_transport: ff.MessageTransport = None
+    _response_compression_threshold: str = None
+    _max_compressible_body_size: str = None
+    _multipart_memfile_limit: str = None
 
     def __init__(self):
         self._version_matcher = re.compile(r'^/v(\d)')
@@ -90,16 +171,34 @@ class LambdaExecutor(ff.DomainService):
 
     def run(self, event: dict, context):
         try:
-            time = self._get_remaining_time(context)
-            if time is not None:
-                with time_limit(time):
-                    return self._do_run(event, context)
+            # Work should wind down at the (soft) deadline. The signal is a last resort that still leaves time to
+            # report the error before Lambda kills the process.
+            self._kernel.deadline = self._get_deadline(context)
+            hard_limit = self._hard_limit_millis(context) if context is not None else None
+            if hard_limit is not None:
+                with time_limit(hard_limit / 1000):
+                    return self._run_unit_of_work(event, context)
             else:
-                return self._do_run(event, context)
+                return self._run_unit_of_work(event, context)
         except Exception as e:
             self._handle_error(e, event, context)
             raise e
 
+    def _run_unit_of_work(self, event: dict, context):
+        if not isinstance(self._message_transport, domain.Outbox):
+            return self._do_run(event, context)
+
+        # Outgoing messages are only sent once the invocation has succeeded.
+        self._message_transport.begin()
+        try:
+            ret = self._do_run(event, context)
+        except Exception:
+            self._message_transport.discard()
+            raise
+        self._message_transport.flush()
+
+        return ret
+
     def _do_run(self, event: dict, context):
         self.debug('Event: %s', event)
         self.debug('Context: %s', context)
@@ -123,25 +222,20 @@ class LambdaExecutor(ff.DomainService):
                 self.debug('Passing through cognito trigger event')
                 return event
 
+        if message is False and domain.LoadPayload.is_pointer(event):
+            # Fire-and-forget invocations offload large messages, like SNS and SQS do.
+            message = self._load_payload(event)
         if message is False:
             message = self._serializer.deserialize(json.dumps(event))
         if isinstance(message, ff.Command):
             try:
-                return self._serializer.deserialize(
-                    self._store_large_payloads_in_s3(
-                        self._serializer.serialize(self.invoke(message))
-                    )
-                )
+                return self._direct_response(self.invoke(message))
             except ff.ConfigurationError:
                 if aws_message is True:
                     return event
                 raise
         elif isinstance(message, ff.Query):
-            return self._serializer.deserialize(
-                self._store_large_payloads_in_s3(
-                    self._serializer.serialize(self.request(message))
-                )
-            )
+            return self._direct_response(self.request(message))
 
         return {
             'statusCode': 200,
@@ -150,6 +244,19 @@ class LambdaExecutor(ff.DomainService):
             'isBase64Encoded': False,
         }
 
+    def _direct_response(self, result: any):
+        if result is None or isinstance(result, (int, float, bool)):
+            return result
+
+        # Serialize once. The runtime only needs JSON-compatible data, so small results are parsed back with the
+        # plain json module, and large ones are handed to S3 as-is.
+        payload = self._serializer.serialize(result)
+        key = self._store_large_payloads_in_s3.store(payload, limit=MAX_RESPONSE_BODY_SIZE)
+        if key is not None:
+            return {'PAYLOAD_KEY': key}
+
+        return json.loads(payload)
+
     def _handle_http_event(self, event: dict):
         route = self._default_matcher.sub('/', event['rawPath'])
         match = self._version_matcher.match(route)
@@ -250,13 +357,20 @@ class LambdaExecutor(ff.DomainService):
 
         self.info('Boundary: %s', boundary)
         ret = {}
-        body = base64.b64decode(body)
-        parser = MultipartParser(io.BytesIO(body), boundary)
+        memfile_limit = int(self._multipart_memfile_limit or DEFAULT_MULTIPART_MEMFILE_LIMIT)
+        parser = MultipartParser(
+            io.BufferedReader(Base64Reader(body)),
+            boundary,
+            memfile_limit=memfile_limit,
+            mem_limit=max(memfile_limit * 4, DEFAULT_MULTIPART_MEM_LIMIT)
+        )
         for part in parser:
             if part.file and part.filename is not None:
+                # Parts larger than the memfile limit have been spooled to a temporary file in /tmp. Hand the open
+                # file to the handler instead of reading it back into memory.
                 ret[part.name] = ff.File(
                     name=part.filename,
-                    content=part.raw,
+                    content=part.raw if part.is_buffered() else part.file,
                     content_type=part.content_type
                 )
             else:
@@ -278,30 +392,108 @@ class LambdaExecutor(ff.DomainService):
             if 'location' in response.headers:
                 status_code = 303
                 headers['location'] = response.headers['location']
-            body = self._serializer.serialize(response.unwrap())
-        else:
-            body = self._serializer.serialize(response)
+            response = response.unwrap()
         headers.update(ACCESS_CONTROL_HEADERS)
         ret = {
             'statusCode': status_code,
             'headers': headers,
-            'body': body,
+            'body': None,
             'isBase64Encoded': False,
         }
 
-        if len(body) > 10000000:
-            download_url = self._s3_service.store_download(body, apply_compression=False)
-            ret['body'] = json.dumps({
+        encoding = self._negotiate_content_encoding()
+        max_size = MAX_RESPONSE_BODY_SIZE
+        if encoding is not None:
+            max_size = int(self._max_compressible_body_size or DEFAULT_MAX_COMPRESSIBLE_BODY_SIZE)
+
+        chunks = iter_json(self._serializer, response)
+        body, size = [], 0
+        for chunk in chunks:
+            body.append(chunk)
+            size += len(chunk)
+            if size > max_size:
+                # The body is too large to return through API Gateway. Keep serializing straight into a multipart
+                # upload so the full body is never held in memory.
+                return self._redirect_to_download(chain(body, chunks))
+
+        body = ''.join(body)
+        ret['body'] = body
+        # Quotes and backslashes are escaped again when the runtime encodes the response envelope.
+        size = len(body) + body.count('"') + body.count('\\')
+
+        threshold = int(self._response_compression_threshold or DEFAULT_COMPRESSION_THRESHOLD)
+        if encoding is not None and len(body) > threshold:
+            ret['body'] = base64.b64encode(self._compress(body.encode('utf-8'), encoding)).decode('ascii')
+            ret['isBase64Encoded'] = True
+            ret['headers']['Content-Encoding'] = encoding
+            ret['headers']['Vary'] = 'Accept-Encoding'
+            size = len(ret['body'])
+
+        if size > MAX_RESPONSE_BODY_SIZE:
+            return self._redirect_to_download(body)
+
+        self.info(f'Proxy Response: %s', ret)
+        return ret
+
+    def _redirect_to_download(self, body: Union[str, Iterator[str]]):
+        download_url = self._s3_service.store_download(body, apply_compression=False)
+        # None of the headers describing the body it replaces (Content-Encoding, Vary, content-range) apply.
+        ret = {
+            'statusCode': 303,
+            'headers': {**ACCESS_CONTROL_HEADERS, 'Location': download_url},
+            'body': json.dumps({
                 'location': download_url
-            })
-            ret['statusCode'] = 303
-            ret['headers']['Location'] = download_url
+            }),
+            'isBase64Encoded': False,
+        }
 
         self.info(f'Proxy Response: %s', ret)
         return ret
 
+    def _negotiate_content_encoding(self):
+        headers = (self._kernel.http_request or {}).get('headers') or {}
+        accept = next((v for k, v in headers.items() if k.lower() == 'accept-encoding'), None)
+        if not accept:
+            return None
+
+        supported = ('br', 'gzip') if brotli is not None else ('gzip',)
+        weights = {}
+        for item in accept.split(','):
+            coding, *params = [p.strip() for p in item.split(';')]
+            q = 1.0
+            for param in params:
+                if param.startswith('q='):
+                    try:
+                        q = float(param[2:])
+                    except ValueError:
+                        q = 0.0
+            weights[coding.lower()] = q
+
+        candidates = [(weights.get(c, weights.get('*', 0.0)), -i, c) for i, c in enumerate(supported)]
+        q, _, coding = max(candidates)
+
+        return coding if q > 0 else None
+
+    @staticmethod
+    def _compress(data: bytes, encoding: str):
+        if encoding == 'br':
+            return brotli.compress(data, quality=5)
+        return gzip.compress(data, compresslevel=6)
+
     def _handle_sqs_event(self, event: dict):
+        """
+        Records that are not handled (the deadline passed, or the payload could not be loaded) are reported as batch
+        item failures, so SQS returns them to the queue instead of deleting them with the rest of the batch.
+        """
+        deadline: domain.Deadline = getattr(self._kernel, 'deadline', None)
+        handled, failures = [], []
         for record in event['Records']:
+            if deadline is not None and deadline.expired():
+                self.info('Deadline reached, returning message %s to the queue', record.get('messageId'))
+                self.nack_message(record)
+                failures.append(record)
+                continue
+
             body = self._serializer.deserialize(record['body'])
             try:
                 message: Union[ff.Event, dict] = self._serializer.deserialize(body['Message'])
@@ -310,13 +502,14 @@ class LambdaExecutor(ff.DomainService):
             except TypeError:
                 message = body
 
-            if isinstance(message, dict) and 'PAYLOAD_KEY' in message:
+            if domain.LoadPayload.is_pointer(message):
                 try:
-                    self.info('Payload key: %s', message['PAYLOAD_KEY'])
-                    message = self._load_payload(message['PAYLOAD_KEY'])
+                    self.info('Payload key: %s', message.get('PAYLOAD_KEY', 'inline'))
+                    message = self._load_payload(message)
                 except Exception as e:
                     self.nack_message(record)
                     self.error(e)
+                    failures.append(record)
                     continue
             if message is None:
                 self.info('Got a null message')
@@ -327,10 +520,13 @@ class LambdaExecutor(ff.DomainService):
                 self.invoke(message)
             else:
                 self.dispatch(message)
-        if len(event['Records']) == 1:
-            self.complete_handshake(event['Records'][0])
-        else:
-            self.complete_batch_handshake(event['Records'])
+            handled.append(record)
+        if len(handled) == 1:
+            self.complete_handshake(handled[0])
+        elif len(handled) > 1:
+            self.complete_batch_handshake(handled)
+
+        return {'batchItemFailures': [{'itemIdentifier': record['messageId']} for record in failures]}
 
     @staticmethod
     def _is_cognito_trigger_event(event: dict):
@@ -347,9 +543,19 @@ class LambdaExecutor(ff.DomainService):
         return False
 
     @staticmethod
-    def _get_remaining_time(context):
+    def _hard_limit_millis(context) -> Optional[float]:
+        # None when the reserve would use up all the remaining time; Lambda's own timeout is the only backstop then.
+        remaining = context.get_remaining_time_in_millis()
+        hard_limit = remaining - max(remaining * HARD_LIMIT_RESERVE, MIN_HARD_LIMIT_RESERVE_MILLIS)
+        return hard_limit if hard_limit > 0 else None
+
+    def _get_deadline(self, context):
+        # Relative to the hard limit, so the deadline always comes first.
         if context is not None:
-            return math.floor((context.get_remaining_time_in_millis() / 1000) * .9)
+            hard_limit = self._hard_limit_millis(context)
+            if hard_limit is None:
+                hard_limit = context.get_remaining_time_in_millis()
+            return domain.Deadline(hard_limit * DEADLINE_RATIO)
 
     def nack_message(self, record: dict):
         pass
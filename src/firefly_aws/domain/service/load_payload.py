@@ -1,21 +1,157 @@
 from __future__ import annotations
 
-import bz2
+import base64
+import io
+import json
+import threading
+from collections import OrderedDict
+from contextlib import closing
+from typing import Union, Callable, BinaryIO, Iterator
 
 import firefly as ff
 
+from .. import compression
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+DEFAULT_CACHE_SIZE = 64 * 1024 * 1024
+DEFAULT_STREAMING_THRESHOLD = 8 * 1024 * 1024
+
+
+class PayloadHandle:
+    """
+    A reference to an offloaded payload that hasn't been downloaded yet. Code that holds a payload key (e.g. one
+    returned by StoreLargePayloadsInS3.store() and passed along in a message) and only needs part of it can stream
+    it, or iterate over part of it, instead of loading all of it.
+    """
+
+    def __init__(self, open_: Callable[[], BinaryIO], load: Callable, read_range: Callable = None):
+        self._open = open_
+        self._load = load
+        self._read_range = read_range
+
+    def open(self) -> BinaryIO:
+        """
+        The decompressed JSON document as a binary stream. The caller closes it; wrap it in contextlib.closing() to
+        use it in a with statement, since older botocore streaming bodies are not context managers.
+        """
+        return self._open()
+
+    def items(self, prefix: str) -> Iterator:
+        """
+        Yields the items under an ijson prefix (e.g. "rows.item") one at a time.
+        """
+        if ijson is None:
+            raise ImportError('The ijson package is required to iterate over payloads (pip install firefly-aws[ijson])')
+        with closing(self.open()) as stream:
+            yield from ijson.items(stream, prefix, use_float=True)
+
+    def read_range(self, start: int, end: int) -> bytes:
+        """
+        Bytes start..end (inclusive) of the stored object. Only meaningful for uncompressed payloads.
+        """
+        if self._read_range is None:
+            raise ValueError('Ranged reads are only supported for uncompressed payloads stored in S3')
+        return self._read_range(start, end)
+
+    def load(self):
+        return self._load()
+
 
 class LoadPayload(ff.DomainService):
     _s3_client = None
     _serializer: ff.Serializer = None
     _bucket: str = None
+    _payload_cache_size: str = None
+    _payload_streaming_threshold: str = None
+
+    def __init__(self):
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, pointer: Union[str, dict]):
+        if isinstance(pointer, dict) and 'PAYLOAD_INLINE' in pointer:
+            data = compression.decompress(base64.b64decode(pointer['PAYLOAD_INLINE']), pointer['PAYLOAD_CODEC'])
+            return self._serializer.deserialize(data)
 
-    def __call__(self, key: str):
-        response = self._s3_client.get_object(
-            Bucket=self._bucket,
-            Key=key
-        )
-        data = response['Body'].read()
-        if key.endswith('bz2'):
-            data = bz2.decompress(data)
+        key = pointer['PAYLOAD_KEY'] if isinstance(pointer, dict) else pointer
+        data = self._cached(key)
+        if data is None:
+            response = self._s3_client.get_object(
+                Bucket=self._bucket,
+                Key=key
+            )
+            codec = compression.codec_for_key(key)
+            if response.get('ContentLength', 0) > int(self._payload_streaming_threshold or DEFAULT_STREAMING_THRESHOLD):
+                # Too big to hold the compressed, decompressed and parsed copies at once.
+                with closing(compression.open_stream(response['Body'], codec)) as stream:
+                    return self._serializer.deserialize(self._parse(stream))
+
+            data = response['Body'].read()
+            if codec is not None:
+                data = compression.decompress(data, codec)
+            self._remember(key, data)
+
+        # Cache the bytes rather than the deserialized payload so callers can't mutate each other's messages.
         return self._serializer.deserialize(data)
+
+    def open(self, pointer: Union[str, dict]) -> PayloadHandle:
+        if isinstance(pointer, dict) and 'PAYLOAD_INLINE' in pointer:
+            return PayloadHandle(
+                lambda: io.BytesIO(
+                    compression.decompress(base64.b64decode(pointer['PAYLOAD_INLINE']), pointer['PAYLOAD_CODEC'])
+                ),
+                lambda: self(pointer)
+            )
+
+        key = pointer['PAYLOAD_KEY'] if isinstance(pointer, dict) else pointer
+        codec = compression.codec_for_key(key)
+
+        def open_():
+            cached = self._cached(key)
+            if cached is not None:
+                return io.BytesIO(cached)
+            body = self._s3_client.get_object(Bucket=self._bucket, Key=key)['Body']
+            return compression.open_stream(body, codec)
+
+        def read_range(start: int, end: int):
+            return self._s3_client.get_object(
+                Bucket=self._bucket, Key=key, Range=f'bytes={start}-{end}'
+            )['Body'].read()
+
+        return PayloadHandle(open_, lambda: self(key), read_range if codec is None else None)
+
+    @staticmethod
+    def _parse(stream: BinaryIO):
+        if ijson is not None:
+            return next(ijson.items(stream, '', use_float=True))
+        return json.load(stream)
+
+    def _cached(self, key: str):
+        with self._lock:
+            data = self._cache.get(key)
+            if data is not None:
+                self._cache.move_to_end(key)
+            return data
+
+    def _remember(self, key: str, data: bytes):
+        limit = int(self._payload_cache_size or DEFAULT_CACHE_SIZE)
+        if len(data) > limit:
+            return
+
+        with self._lock:
+            if key in self._cache:
+                return
+            self._cache[key] = data
+            self._cache_bytes += len(data)
+            while self._cache_bytes > limit:
+                _, evicted = self._cache.popitem(last=False)
+                self._cache_bytes -= len(evicted)
+
+    @staticmethod
+    def is_pointer(message) -> bool:
+        return isinstance(message, dict) and ('PAYLOAD_KEY' in message or 'PAYLOAD_INLINE' in message)
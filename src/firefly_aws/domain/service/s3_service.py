@@ -15,9 +15,11 @@
 from __future__ import annotations
 
 from abc import ABC, abstractmethod
+from typing import Union, Iterable, BinaryIO
 
 
 class S3Service(ABC):
     @abstractmethod
-    def store_download(self, data: str, extension: str = None, file_name: str = None, apply_compression: bool = True):
+    def store_download(self, data: Union[str, bytes, BinaryIO, Iterable[Union[str, bytes]]], extension: str = None,
+                       file_name: str = None, apply_compression: bool = True):
         pass
@@ -1,25 +1,102 @@
 from __future__ import annotations
 
-import uuid
+import base64
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from time import monotonic
+from typing import Optional
 
 import firefly as ff
+from botocore.exceptions import ClientError
+
+from .. import compression
+
+DEFAULT_OFFLOAD_THRESHOLD = 64_000
+# SNS and SQS cap messages at 256 KB; leave room for message attributes and the SNS envelope.
+INLINE_LIMIT = 250_000
+# Objects under tmp/ expire a day after they were last written, and S3 may remove them any time after that. An
+# existing object (seen by this process, or found with a HEAD request) is only reused while it is less than
+# DEDUP_MAX_AGE old, so every pointer handed out stays readable for at least 1 day - DEDUP_MAX_AGE. Older objects are
+# written again, which resets their expiration.
+DEDUP_MAX_AGE = 60 * 60
+MEMO_SIZE = 1024
 
 
 class StoreLargePayloadsInS3(ff.DomainService):
     _s3_client = None
     _serializer: ff.Serializer = None
     _bucket: str = None
+    _payload_codec: str = None
+    _payload_compression_level: str = None
+
+    def __init__(self):
+        self._written = OrderedDict()
+        self._lock = threading.Lock()
 
     def __call__(self, payload: str):
-        if len(payload) > 64_000:
-            key = f'tmp/{str(uuid.uuid1())}.json'
+        data = payload.encode('utf-8')
+        if len(data) <= DEFAULT_OFFLOAD_THRESHOLD:
+            return payload
+
+        codec = self._codec()
+        compressed = compression.compress(data, codec, self._level())
+        if codec != compression.NONE:
+            inline = self._serializer.serialize({
+                'PAYLOAD_INLINE': base64.b64encode(compressed).decode('ascii'),
+                'PAYLOAD_CODEC': codec,
+            })
+            if len(inline) <= INLINE_LIMIT:
+                return inline
+
+        return self._serializer.serialize({
+            'PAYLOAD_KEY': self._put(data, compressed, codec),
+        })
+
+    def store(self, payload: str, limit: int = DEFAULT_OFFLOAD_THRESHOLD) -> Optional[str]:
+        data = payload.encode('utf-8')
+        if len(data) > limit:
+            codec = self._codec()
+            return self._put(data, compression.compress(data, codec, self._level()), codec)
+
+    def _put(self, data: bytes, body: bytes, codec: str) -> str:
+        # Keys are derived from the uncompressed bytes; gzip output embeds a timestamp and isn't stable.
+        key = f'tmp/{hashlib.sha256(data).hexdigest()}.json{compression.key_suffix(codec)}'
+
+        with self._lock:
+            written = self._written.get(key)
+        if written is not None and monotonic() - written < DEDUP_MAX_AGE:
+            return key
+
+        age = self._age(key)
+        if age is None or age >= DEDUP_MAX_AGE:
             self._s3_client.put_object(
-                Body=payload,
+                Body=body,
                 Bucket=self._bucket,
                 Key=key
             )
-            return self._serializer.serialize({
-                'PAYLOAD_KEY': key,
-            })
+            age = 0
+
+        with self._lock:
+            self._written[key] = monotonic() - age
+            self._written.move_to_end(key)
+            while len(self._written) > MEMO_SIZE:
+                self._written.popitem(last=False)
+
+        return key
+
+    def _age(self, key: str) -> Optional[float]:
+        try:
+            response = self._s3_client.head_object(Bucket=self._bucket, Key=key)
+        except ClientError:
+            return None
+
+        last_modified = response['LastModified']
+        return max(0., (datetime.now(last_modified.tzinfo) - last_modified).total_seconds())
+
+    def _codec(self):
+        return self._payload_codec or compression.DEFAULT_CODEC
 
-        return payload
+    def _level(self):
+        return int(self._payload_compression_level) if self._payload_compression_level else None
@@ -14,86 +14,620 @@
 
 from __future__ import annotations
 
-from typing import List, Callable, Optional, Union
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import fields
+from datetime import datetime, date
+from decimal import Decimal
+from functools import reduce
+from time import sleep
+from typing import List, Callable, Optional, Union, Tuple, get_type_hints
 
 import firefly as ff
+import firefly_aws.domain as domain
+from firefly_aws.domain import compression, encoding
 import inflection
 from botocore.exceptions import ClientError
 from firefly import domain as ffd
 from firefly.domain.repository.repository import T
 
+INDEX_SHARDS = 16
+FETCH_CONCURRENCY = 16
+WRITE_CONCURRENCY = 16
+DELETE_BATCH_SIZE = 1000
+INDEX_UPDATE_RETRIES = 10
+MAX_CONFLICTS = 5
+CONFLICT_ERRORS = ('PreconditionFailed', 'ConditionalRequestConflict')
+SELECT_TYPES = {datetime: 'TIMESTAMP', date: 'TIMESTAMP', int: 'INT', float: 'FLOAT', Decimal: 'DECIMAL'}
+PRECONDITION_HEADERS = {'IfMatch': 'If-Match', 'IfNoneMatch': 'If-None-Match'}
+
+_preconditions = threading.local()
+
+
+def _add_precondition_headers(params, **kwargs):
+    params['headers'].update(getattr(_preconditions, 'headers', None) or {})
+
 
 class S3Repository(ff.Repository[T]):
-    def __init__(self, s3_client, serializer: ff.Serializer, bucket: str, prefix: str = 'object-store/aggregates'):
+    """
+    Stores each aggregate as an object encoded with the repository's codec: "json" (the default), "msgpack" or
+    "cbor", optionally followed by a compression such as "+zstd". Objects are read according to their key suffix,
+    so aggregates stored as JSON (or with any other codec) before the current one was configured stay readable and
+    are rewritten with the current codec on their next save. Indexed fields (and the id) are also kept in sharded
+    JSON lines manifests under _index/, so criteria queries and listings read the manifests instead of every object.
+
+    With conditional_writes enabled, aggregates are written with If-Match on the ETag seen when they were loaded
+    (If-None-Match for new ones), and a lost race raises ConcurrentUpdateDetected instead of overwriting. Index shards
+    are shared by every writer, so they are always written that way, and only when an indexed value changed. Shards
+    are read once per unit of work, like the aggregates, and are read again after reset().
+
+    S3 has no multi-object transactions, so a commit that fails part way undoes what it already wrote: new objects
+    are deleted, changed and deleted ones are put back from the bytes they were loaded from, and updated index
+    shards get their previous rows back. The loaded bytes are kept until reset() for that reason.
+    """
+
+    def __init__(self, s3_client, serializer: ff.Serializer, bucket: str, prefix: str = 'object-store/aggregates',
+                 index_shards: int = INDEX_SHARDS, use_select: bool = False,
+                 fetch_concurrency: int = FETCH_CONCURRENCY, conditional_writes: bool = True, codec: str = 'json',
+                 max_conflicts: int = MAX_CONFLICTS, file_system: ff.FileSystem = None):
+        super().__init__()
+        if use_select and file_system is None:
+            raise ff.ConfigurationError('use_select needs the S3 file system to run S3 Select over the index')
         self._s3_client = s3_client
         self._serializer = serializer
         self._bucket = bucket
         name = inflection.pluralize(inflection.dasherize(inflection.underscore(self._type().__name__)))
         self._storage_path = f'{prefix}/{name}'.lstrip('/')
+        self._index_shards = index_shards
+        self._use_select = use_select
+        self._file_system = file_system
+        self._fetch_concurrency = fetch_concurrency
+        self._conditional_writes = conditional_writes
+        self._native_preconditions = None
+        self._max_conflicts = max_conflicts
+        self._conflicts = 0
+        self._format, self._compression = encoding.parse_codec(codec)
+        self._etags = {}
+        self._previous_keys = {}
+        self._originals = {}
+        self._shards = {}
+        self._identity_map = {}
+        self._identity_lock = threading.Lock()
+        self._index_fields = self._get_index_fields()
+        self._index_field_types = None
 
     def add(self, entity: T):
+        self._put(entity)
+        self._update_index(self._changed_rows({entity.id_value(): self._index_row(entity)}))
+        self._delete_previous_keys([entity.id_value()])
+
+    def append(self, entity: Union[T, List[T], Tuple[T]], **kwargs):
+        if not isinstance(entity, (list, tuple)):
+            entity = [entity]
+
+        for e in entity:
+            if e not in self._entities:
+                self._entities.append(e)
+                self.debug('Entity added to repository: %s', str(e))
+            with self._identity_lock:
+                self._identity_map[e.id_value()] = e
+
+    def remove(self, entity: Union[T, List[T], Tuple[T]], **kwargs):
+        if not isinstance(entity, (list, tuple)):
+            entity = [entity]
+
+        for e in entity:
+            self.debug('Entity removed from repository: %s', str(e))
+            self._deletions.append(e)
+            if e in self._entities:
+                self._entities.remove(e)
+            with self._identity_lock:
+                self._identity_map.pop(e.id_value(), None)
+
+    def commit(self, **kwargs):
+        """
+        Writes new and changed aggregates concurrently (unchanged ones are skipped by content hash), deletes removed
+        ones in batches, and updates each affected index shard once. On failure the commit is undone before the
+        error is raised.
+
+        The transaction middleware retries the message on ConcurrentUpdateDetected without limit, so each conflict
+        backs off first, and after max_conflicts in a row a RepositoryError is raised instead.
+        """
+        deletions = list({e.id_value(): e for e in self._deletions}.values())
+        writes = [(e, self._get_hash(e)) for e in self._new_entities() + self._changed_entities()]
+        self.debug('Committing %d write(s) and %d deletion(s)', len(writes), len(deletions))
+        if len(writes) == 0 and len(deletions) == 0:
+            return
+
+        rows = {e.id_value(): self._index_row(e) for e, _ in writes}
+        rows.update({e.id_value(): None for e in deletions})
+        rows = self._changed_rows(rows)
+        previous_rows = {e.id_value(): self._index_row(e) for e in deletions}
+        previous_rows.update({id_: original[2] for id_, original in self._originals.items() if id_ in rows})
+
+        written, deleted = [], []
+        try:
+            self._put_all([e for e, _ in writes], written)
+            for i in range(0, len(deletions), DELETE_BATCH_SIZE):
+                batch = deletions[i:i + DELETE_BATCH_SIZE]
+                deleted.extend(batch)
+                self._delete([self._key(e.id_value()) for e in batch])
+            self._update_index(rows, previous_rows)
+        except Exception as e:
+            self._rollback(written, deleted)
+            if isinstance(e, ffd.ConcurrentUpdateDetected):
+                self._conflicts += 1
+                if self._conflicts >= self._max_conflicts:
+                    self._conflicts = 0
+                    raise ff.RepositoryError(f'Giving up after {self._max_conflicts} concurrent updates') from e
+                sleep(domain.jittered_backoff(self._conflicts))
+            raise
+        self._conflicts = 0
+
+        deleted_ids = [e.id_value() for e in deletions]
+        self._delete_previous_keys([e.id_value() for e, _ in writes] + deleted_ids)
+        for entity, hash_ in writes:
+            self._entity_hashes[entity.id_value()] = hash_
+            self._originals.pop(entity.id_value(), None)
+        for id_ in deleted_ids:
+            self._entity_hashes.pop(id_, None)
+            self._etags.pop(id_, None)
+            self._originals.pop(id_, None)
+        self._deletions = []
+
+    def find(self, exp: Union[str, Callable, ffd.BinaryOp]) -> Optional[T]:
+        if isinstance(exp, str):
+            results = self.find_many([exp])
+            return results[0] if len(results) > 0 else None
+
+        results = self.filter(exp)
+        return results[0] if len(results) > 0 else None
+
+    def find_many(self, ids: List[str]) -> List[T]:
+        """
+        Returns the aggregates for the given ids, in order, skipping ids that do not exist. Aggregates already loaded
+        by this repository come from the identity map; the rest are fetched concurrently.
+        """
+        ids = list(dict.fromkeys(ids))
+        with self._identity_lock:
+            missing = [id_ for id_ in ids if id_ not in self._identity_map]
+
+        if len(missing) == 1:
+            self._load(missing[0])
+        elif len(missing) > 1:
+            with ThreadPoolExecutor(max_workers=min(self._fetch_concurrency, len(missing))) as executor:
+                list(executor.map(self._load, missing))
+
+        with self._identity_lock:
+            return [self._identity_map[id_] for id_ in ids if id_ in self._identity_map]
+
+    def filter(self, cb: Union[Callable, ffd.BinaryOp]) -> List[T]:
+        criteria = self._get_search_criteria(cb)
+        return [e for e in self.find_many(self._matching_ids(criteria)) if criteria.matches(e)]
+
+    def reduce(self, cb: Callable) -> Optional[T]:
+        return reduce(cb, self)
+
+    def sort(self, cb: Optional[Callable] = None, **kwargs):
+        return sorted(self, key=cb, **kwargs)
+
+    def reset(self):
+        super().reset()
+        with self._identity_lock:
+            self._identity_map = {}
+            self._etags = {}
+            self._previous_keys = {}
+            self._originals = {}
+            self._shards = {}
+
+    def clear(self):
+        keys = []
+        paginator_params = {'Bucket': self._bucket, 'Prefix': f'{self._storage_path}/'}
+        while True:
+            response = self._s3_client.list_objects_v2(**paginator_params)
+            keys.extend(item['Key'] for item in response.get('Contents', []))
+            if not response.get('IsTruncated'):
+                break
+            paginator_params['ContinuationToken'] = response['NextContinuationToken']
+
+        for i in range(0, len(keys), DELETE_BATCH_SIZE):
+            self._delete(keys[i:i + DELETE_BATCH_SIZE])
+        self.reset()
+
+    def destroy(self):
+        self.clear()
+
+    def rebuild_index(self):
+        """
+        Regenerates the manifests from the stored objects, e.g. after adding an index to a field.
+        """
+        ids = []
+        params = {'Bucket': self._bucket, 'Prefix': f'{self._storage_path}/'}
+        while True:
+            response = self._s3_client.list_objects_v2(**params)
+            for item in response.get('Contents', []):
+                codec = encoding.codec_for_key(item['Key'])
+                if codec is not None and '/_index/' not in item['Key']:
+                    ids.append(item['Key'][len(self._storage_path) + 1:-len(encoding.key_suffix(*codec))])
+            if not response.get('IsTruncated'):
+                break
+            params['ContinuationToken'] = response['NextContinuationToken']
+
+        shards = {}
+        for entity in self.find_many(list(dict.fromkeys(ids))):
+            shards.setdefault(self._shard(entity.id_value()), {})[entity.id_value()] = self._index_row(entity)
+        for shard in range(self._index_shards):
+            self._write_shard(shard, shards.get(shard, {}))
+
+    def execute_ddl(self):
+        raise NotImplementedError()
+
+    def raw(self, cb: Union[Callable, ffd.BinaryOp] = None, limit: int = None):
+        raise NotImplementedError()
+
+    def __iter__(self):
+        return iter(self.find_many(self._matching_ids(None)))
+
+    def __len__(self):
+        return sum(len(rows) for rows in self._read_shards())
+
+    def __getitem__(self, item):
+        ids = self._matching_ids(None)
+        if isinstance(item, slice):
+            return self.find_many(ids[item])
+        return self.find_many([ids[item]])[0]
+
+    def _load(self, id_: str):
+        key = self._key(id_)
+        try:
+            response = self._get(key)
+            if response is None:
+                key = self._find_previous_key(id_)
+                response = self._get(key) if key is not None else None
+            if response is None:
+                return
+            body = response['Body'].read()
+            data = self._decode(body, key)
+        except ClientError as e:
+            raise ff.RepositoryError(str(e))
+
+        entity = self._type().from_dict(data)
+        with self._identity_lock:
+            if id_ in self._identity_map:
+                return
+            self._identity_map[id_] = entity
+            self._originals[id_] = (key, body, self._index_row(entity))
+            if key == self._key(id_):
+                self._etags[id_] = response.get('ETag')
+            else:
+                self._previous_keys[id_] = key
+            # Track loaded aggregates so commit() can tell whether they changed.
+            if entity not in self._entities:
+                self.register_entity(entity)
+
+    def _put(self, entity: T):
+        id_ = entity.id_value()
+        try:
+            response = self._put_object(
+                self._precondition(self._etags.get(id_)),
+                Bucket=self._bucket,
+                Key=self._key(id_),
+                Body=self._encode(entity.to_dict()),
+            )
+        except ClientError as e:
+            if self._is_conflict(e):
+                raise ffd.ConcurrentUpdateDetected()
+            raise ff.RepositoryError(str(e))
+        self._etags[id_] = response.get('ETag')
+
+    def _put_all(self, entities: List[T], written: List[T]):
+        """
+        Puts the entities concurrently, appending the ones that were written to written, and raises the first
+        error (a conflict, if there was one) once every put has finished.
+        """
+        if len(entities) == 0:
+            return
+
+        with ThreadPoolExecutor(max_workers=min(WRITE_CONCURRENCY, len(entities))) as executor:
+            futures = [(entity, executor.submit(self._put, entity)) for entity in entities]
+
+        errors = []
+        for entity, future in futures:
+            if future.exception() is None:
+                written.append(entity)
+            else:
+                errors.append(future.exception())
+        if len(errors) > 0:
+            raise next((e for e in errors if isinstance(e, ffd.ConcurrentUpdateDetected)), errors[0])
+
+    def _rollback(self, written: List[T], deleted: List[T]):
+        """
+        Best effort: a failure here is logged, so it does not hide the error that caused the rollback.
+        """
+        deleted_ids = {e.id_value() for e in deleted}
+        for entity in written + deleted:
+            id_ = entity.id_value()
+            try:
+                original = self._originals.get(id_)
+                if original is not None and original[0] == self._key(id_):
+                    response = self._put_object(
+                        self._precondition(None if id_ in deleted_ids else self._etags.get(id_)),
+                        Bucket=self._bucket, Key=original[0], Body=original[1]
+                    )
+                    self._etags[id_] = response.get('ETag')
+                elif id_ not in deleted_ids:
+                    self._delete([self._key(id_)])
+                    self._etags.pop(id_, None)
+            except Exception as e:
+                if not (isinstance(e, ClientError) and self._is_conflict(e)):
+                    self.error('Could not roll back %s: %s', id_, str(e))
+
+    def _delete_previous_keys(self, ids: List[str]):
+        """
+        Removes copies stored with an earlier codec once the commit has gone through. A failure only leaves a copy
+        that is never read, so it is logged and retried on the next commit.
+        """
+        keys = [self._previous_keys[id_] for id_ in ids if id_ in self._previous_keys]
+        try:
+            for i in range(0, len(keys), DELETE_BATCH_SIZE):
+                self._delete(keys[i:i + DELETE_BATCH_SIZE])
+        except ff.RepositoryError as e:
+            self.error('Could not delete previous copies: %s', str(e))
+            return
+        for id_ in ids:
+            self._previous_keys.pop(id_, None)
+
+    def _get(self, key: str) -> Optional[dict]:
+        try:
+            return self._s3_client.get_object(Bucket=self._bucket, Key=key)
+        except ClientError as e:
+            if 'NoSuchKey' in str(e):
+                return None
+            raise e
+
+    def _find_previous_key(self, id_: str) -> Optional[str]:
+        """
+        Looks for the aggregate stored with a codec other than the current one, e.g. as JSON from before a codec
+        was configured.
+        """
+        response = self._s3_client.list_objects_v2(Bucket=self._bucket, Prefix=f'{self._storage_path}/{id_}.')
+        for item in response.get('Contents', []):
+            codec = encoding.codec_for_key(item['Key'])
+            if codec is not None and item['Key'][:-len(encoding.key_suffix(*codec))] == f'{self._storage_path}/{id_}':
+                return item['Key']
+        return None
+
+    def _encode(self, data: dict):
+        if self._format == encoding.JSON:
+            body = self._serializer.serialize(data)
+            if self._compression == compression.NONE:
+                return body
+            body = body.encode('utf-8')
+        else:
+            body = encoding.encode(data, self._format)
+        return compression.compress(body, self._compression)
+
+    def _decode(self, body: bytes, key: str) -> dict:
+        fmt, compression_codec = encoding.codec_for_key(key)
+        body = compression.decompress(body, compression_codec)
+        if fmt == encoding.JSON:
+            return self._serializer.deserialize(body)
+        return encoding.decode(body, fmt)
+
+    def _precondition(self, etag: Optional[str], required: bool = False) -> dict:
+        if not (self._conditional_writes or required):
+            return {}
+        return {'IfMatch': etag} if etag is not None else {'IfNoneMatch': '*'}
+
+    def _put_object(self, precondition: dict, **kwargs):
+        """
+        botocore only models IfMatch/IfNoneMatch on PutObject from 1.35.x on. Older clients reject them as unknown
+        parameters, so there the precondition is sent as raw headers instead.
+        """
+        if len(precondition) == 0 or self._supports_native_preconditions():
+            return self._s3_client.put_object(**kwargs, **precondition)
+
+        _preconditions.headers = {PRECONDITION_HEADERS[k]: v for k, v in precondition.items()}
+        try:
+            return self._s3_client.put_object(**kwargs)
+        finally:
+            _preconditions.headers = None
+
+    def _supports_native_preconditions(self) -> bool:
+        if self._native_preconditions is None:
+            try:
+                members = self._s3_client.meta.service_model.operation_model('PutObject').input_shape.members
+            except AttributeError:
+                # Not a botocore client
+                self._native_preconditions = True
+            else:
+                self._native_preconditions = 'IfMatch' in members and 'IfNoneMatch' in members
+                if not self._native_preconditions:
+                    self._s3_client.meta.events.register(
+                        'before-call.s3.PutObject', _add_precondition_headers,
+                        unique_id='firefly-aws-precondition-headers'
+                    )
+        return self._native_preconditions
+
+    @staticmethod
+    def _is_conflict(e: ClientError):
+        return e.response.get('Error', {}).get('Code') in CONFLICT_ERRORS
+
+    def _delete(self, keys: List[str]):
         try:
-            self._s3_client.put_object(
+            response = self._s3_client.delete_objects(
                 Bucket=self._bucket,
-                Key=f'{self._storage_path}/{entity.id_value()}.json',
-                Body=self._serializer.serialize(entity.to_dict()),
+                Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True}
             )
         except ClientError as e:
             raise ff.RepositoryError(str(e))
+        if len(response.get('Errors') or []) > 0:
+            raise ff.RepositoryError(f"Failed to delete {[e['Key'] for e in response['Errors']]}")
+
+    def _key(self, id_: str):
+        return f'{self._storage_path}/{id_}{encoding.key_suffix(self._format, self._compression)}'
+
+    def _get_index_fields(self) -> List[str]:
+        return [f.name for f in fields(self._type()) if f.metadata.get('index') or f.metadata.get('id')]
+
+    def _index_row(self, entity: T) -> dict:
+        data = entity.to_dict()
+        return {name: data.get(name) for name in self._index_fields}
+
+    def _changed_rows(self, rows: dict) -> dict:
+        # Aggregates that were loaded and kept their indexed values leave the index as it is.
+        return {
+            id_: row for id_, row in rows.items()
+            if row is None or id_ not in self._originals or self._originals[id_][2] != row
+        }
+
+    def _shard(self, id_: str) -> int:
+        return zlib.crc32(str(id_).encode('utf-8')) % self._index_shards
+
+    def _shard_key(self, shard: int) -> str:
+        return f'{self._storage_path}/_index/shard-{shard:03d}.jsonl'
 
-    def remove(self, entity: T):
+    def _read_shard(self, shard: int) -> dict:
+        if shard not in self._shards:
+            self._shards[shard] = self._read_versioned_shard(shard)
+        return dict(self._shards[shard][0])
+
+    def _read_versioned_shard(self, shard: int) -> Tuple[dict, Optional[str]]:
         try:
-            self._s3_client.delete_object(
+            response = self._s3_client.get_object(Bucket=self._bucket, Key=self._shard_key(shard))
+        except ClientError as e:
+            if 'NoSuchKey' in str(e):
+                return {}, None
+            raise ff.RepositoryError(str(e))
+
+        id_name = self._type().id_name()
+        rows = {}
+        for line in response['Body'].read().decode('utf-8').splitlines():
+            if line.strip():
+                row = self._serializer.deserialize(line)
+                rows[row[id_name]] = row
+        return rows, response.get('ETag')
+
+    def _write_shard(self, shard: int, rows: dict, etag: Optional[str] = None, conditional: bool = False):
+        try:
+            response = self._put_object(
+                self._precondition(etag, required=True) if conditional else {},
                 Bucket=self._bucket,
-                Key=f'{self._storage_path}/{entity.id_value()}',
+                Key=self._shard_key(shard),
+                Body='\n'.join(self._serializer.serialize(row) for row in rows.values()),
             )
         except ClientError as e:
+            self._shards.pop(shard, None)
+            if self._is_conflict(e):
+                raise ffd.ConcurrentUpdateDetected()
             raise ff.RepositoryError(str(e))
+        self._shards[shard] = (rows, response.get('ETag'))
 
-    def find(self, exp: Union[str, Callable]) -> Optional[T]:
-        if isinstance(exp, str):
-            try:
-                response = self._s3_client.get_object(
-                    Bucket=self._bucket,
-                    Key=f'{self._storage_path}/{exp}.json',
-                )
-                data = self._serializer.deserialize(response['Body'].read())
-                return self._type().from_dict(data)
-            except ClientError as e:
-                if 'NoSuchKey' in str(e):
-                    return None
-                raise ff.RepositoryError(str(e))
-
-        # TODO implement search criteria
-
-    def filter(self, cb: Callable) -> List[T]:
-        # TODO implement search criteria
-        pass
+    def _read_shards(self) -> List[dict]:
+        with ThreadPoolExecutor(max_workers=min(self._fetch_concurrency, self._index_shards)) as executor:
+            return list(executor.map(self._read_shard, range(self._index_shards)))
 
-    def reduce(self, cb: Callable) -> Optional[T]:
-        # TODO implement search criteria
-        pass
+    def _update_index(self, rows: dict, previous_rows: dict = None):
+        """
+        Applies rows (id -> index row, or None to drop the id) to each affected shard. If a shard fails, the shards
+        already updated get previous_rows back (ids missing from previous_rows are dropped).
+        """
+        changes = {}
+        for id_, row in rows.items():
+            changes.setdefault(self._shard(id_), []).append((id_, row))
 
-    def append(self, entity: T):
-        raise NotImplementedError()
+        updated = []
+        try:
+            for shard, shard_rows in changes.items():
+                self._apply_index_changes_with_retry(shard, shard_rows)
+                updated.append(shard)
+        except Exception:
+            if previous_rows is not None:
+                for shard in updated:
+                    try:
+                        self._apply_index_changes_with_retry(
+                            shard, [(id_, previous_rows.get(id_)) for id_, _ in changes[shard]]
+                        )
+                    except Exception as e:
+                        self.error('Could not roll back index shard %d: %s', shard, str(e))
+            raise
 
-    def commit(self):
-        raise NotImplementedError()
+    def _apply_index_changes_with_retry(self, shard: int, rows: List[tuple]):
+        # Shards are shared by every writer, so a lost race re-reads the shard and applies the changes again.
+        domain.retry_with_jitter(
+            lambda: self._apply_index_changes(shard, rows), retries=INDEX_UPDATE_RETRIES, base=.05,
+            catch=ffd.ConcurrentUpdateDetected
+        )
 
-    def execute_ddl(self):
-        raise NotImplementedError()
+    def _apply_index_changes(self, shard: int, rows: List[tuple]):
+        current, etag = self._read_versioned_shard(shard)
+        for id_, row in rows:
+            if row is None:
+                current.pop(id_, None)
+            else:
+                current[id_] = row
+        self._write_shard(shard, current, etag, conditional=True)
 
-    def raw(self, cb: Union[Callable, ffd.BinaryOp] = None, limit: int = None):
-        raise NotImplementedError()
+    def _matching_ids(self, criteria: Optional[ffd.BinaryOp]) -> List[str]:
+        index_criteria = self._index_criteria(criteria) if criteria is not None else None
+        if index_criteria is not None and self._use_select:
+            return self._select_ids(index_criteria)
 
-    def __iter__(self):
-        pass
+        id_name = self._type().id_name()
+        ids = []
+        for rows in self._read_shards():
+            for row in rows.values():
+                if index_criteria is None or index_criteria.matches(self._typed_row(row)):
+                    ids.append(row[id_name])
+        return sorted(ids)
 
-    def __next__(self):
-        pass
+    def _select_ids(self, criteria: ffd.BinaryOp) -> List[str]:
+        id_name = self._type().id_name()
+        types = {name: SELECT_TYPES[type_] for name, type_ in self._field_types().items() if type_ in SELECT_TYPES}
+        try:
+            rows = self._file_system.scan(
+                f'{self._bucket}/{self._storage_path}/_index/', [id_name], criteria, types=types
+            )
+            return sorted(row[id_name] for row in rows)
+        except ClientError as e:
+            raise ff.RepositoryError(str(e))
 
-    def __len__(self):
-        pass
+    def _index_criteria(self, criteria: ffd.BinaryOp) -> Optional[ffd.BinaryOp]:
+        """
+        The part of the criteria that can be answered from the index. Clauses on unindexed fields are dropped
+        from AND (which only widens the candidates), but make an OR unanswerable.
+        """
+        if isinstance(criteria, ffd.BinaryOp) and criteria.op in ('and', 'or'):
+            lhv, rhv = self._index_criteria(criteria.lhv), self._index_criteria(criteria.rhv)
+            if criteria.op == 'and':
+                if lhv is None or rhv is None:
+                    return lhv or rhv
+                return ffd.BinaryOp(lhv, 'and', rhv)
+            return ffd.BinaryOp(lhv, 'or', rhv) if lhv is not None and rhv is not None else None
+
+        for operand in (criteria.lhv, criteria.rhv):
+            if isinstance(operand, (ffd.Attr, ffd.AttributeString)) and \
+                    str(operand).split('.')[0] not in self._index_fields:
+                return None
+        return criteria
+
+    def _typed_row(self, row: dict) -> dict:
+        # Dates are stored as ISO strings; compare them as dates, like the criteria do.
+        for name, type_ in self._field_types().items():
+            if type_ in (datetime, date) and isinstance(row.get(name), str):
+                try:
+                    row[name] = type_.fromisoformat(row[name])
+                except ValueError:
+                    pass
+        return row
+
+    def _field_types(self) -> dict:
+        if self._index_field_types is None:
+            try:
+                hints = get_type_hints(self._type())
+            except Exception:
+                hints = {}
+            self._index_field_types = {name: hints[name] for name in self._index_fields if name in hints}
+        return self._index_field_types
 
-    def __getitem__(self, item):
-        pass
@@ -18,7 +18,8 @@ from typing import Type, TypeVar
 
 import firefly as ff
 import firefly_di as di
-from firefly_aws.infrastructure.repository.s3.s3_repository import S3Repository
+from firefly_aws.infrastructure.repository.s3.s3_repository import S3Repository, INDEX_SHARDS, FETCH_CONCURRENCY, \
+    MAX_CONFLICTS
 
 E = TypeVar('E', bound=ff.Entity)
 
@@ -36,7 +37,15 @@ class S3RepositoryFactory(ff.RepositoryFactory):
             pass
 
         config = self._context_map.get_context('firefly_aws').config
+        # e.g. codec: msgpack+zstd, or per entity under codecs: {MyAggregate: cbor}
+        codec = (config.get('codecs') or {}).get(entity.__name__, config.get('codec', 'json'))
+        use_select = config.get('index_select', False)
 
         return Repo(
-            self._container.s3_client, self._container.serializer, bucket=config.get('bucket'), prefix=self._prefix
+            self._container.s3_client, self._container.serializer, bucket=config.get('bucket'), prefix=self._prefix,
+            index_shards=config.get('index_shards', INDEX_SHARDS), use_select=use_select,
+            fetch_concurrency=config.get('fetch_concurrency', FETCH_CONCURRENCY),
+            conditional_writes=config.get('conditional_writes', True), codec=codec,
+            max_conflicts=config.get('max_conflicts', MAX_CONFLICTS),
+            file_system=self._container.file_system if use_select else None
         )
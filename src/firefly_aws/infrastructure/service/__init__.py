@@ -19,4 +19,6 @@ from .cognito_jwt_decoder import CognitoJwtDecoder
 from .data_api import DataApi
 from .ddb_mutex import DdbMutex
 from .ddb_rate_limiter import DdbRateLimiter
+from .s3_file_cache import S3FileCache
 from .s3_file_system import S3FileSystem
+from .s3_select_compiler import S3SelectCompiler
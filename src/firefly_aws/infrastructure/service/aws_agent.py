@@ -340,6 +340,7 @@ class AwsAgent(ff.Agent, ResourceNameAware, ff.LoggerAware):
             BatchSize=1,
             Enabled=True,
             EventSourceArn=GetAtt(queue, 'Arn'),
+            FunctionResponseTypes=['ReportBatchItemFailures'],
             FunctionName=f'{self._service_name(service.name)}Async',
             DependsOn=[queue, async_lambda]
         ))
@@ -15,76 +15,325 @@
 from __future__ import annotations
 
 import uuid
-from typing import Any, Union
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep
+from typing import Any, Union, List, Tuple, Callable
 
 import firefly as ff
 import firefly_aws as domain
-from botocore.exceptions import ClientError
+from botocore.exceptions import ClientError, BotoCoreError
 from firefly import Query, Command, Event
 
+RETRY_MIN_MILLIS = 5000
+BATCH_SIZE = 10
+# SNS and SQS both cap the total size of a batch request at 256 KB.
+MAX_BATCH_BYTES = 256 * 1024
+PUBLISH_CONCURRENCY = 8
+PUBLISH_RETRIES = 3
+PUBLISH_RETRY_WAIT = .1
+FAN_OUT_CONCURRENCY = 16
+FIRE_AND_FORGET = 'fire_and_forget'
+# Lambda errors that are worth retrying; anything else (bad payload, missing function, ...) fails fast.
+RETRYABLE_LAMBDA_ERRORS = (
+    'TooManyRequestsException',
+    'ServiceException',
+    'EC2ThrottledException',
+    'ResourceNotReadyException',
+    'ResourceConflictException',
+)
 
-class BotoMessageTransport(ff.MessageTransport, domain.ResourceNameAware):
+
+class BotoMessageTransport(ff.MessageTransport, domain.ResourceNameAware, domain.DeadlineAware, domain.Outbox):
     _serializer: ff.Serializer = None
+    _kernel: ff.Kernel = None
+    _context_map: ff.ContextMap = None
+    _command_resolver: ff.CommandResolvingMiddleware = None
     _store_large_payloads_in_s3: domain.StoreLargePayloadsInS3 = None
     _load_payload: domain.LoadPayload = None
     _lambda_client = None
     _sns_client = None
-    _sqs_resource = None
+    _sqs_client = None
     _s3_client = None
     _bucket: str = None
 
+    def __init__(self):
+        self._buffering = False
+        self._events: List[Tuple[str, dict]] = []
+        self._commands: List[Tuple[str, dict]] = []
+        self._queue_urls = {}
+
     def dispatch(self, event: Event) -> None:
+        topic_arn = self._topic_arn(event.get_context())
+        entry = {
+            'Message': self._store_large_payloads_in_s3(self._serializer.serialize(event)),
+            'MessageAttributes': {
+                '_name': {
+                    'DataType': 'String',
+                    'StringValue': event.__class__.__name__,
+                },
+                '_type': {
+                    'DataType': 'String',
+                    'StringValue': 'event'
+                },
+                '_context': {
+                    'DataType': 'String',
+                    'StringValue': event.get_context()
+                },
+            }
+        }
+
+        if self._buffering:
+            self._events.append((topic_arn, entry))
+            return
+
         try:
-            self._sns_client.publish(
-                TopicArn=self._topic_arn(event.get_context()),
-                Message=self._store_large_payloads_in_s3(self._serializer.serialize(event)),
-                MessageAttributes={
-                    '_name': {
-                        'DataType': 'String',
-                        'StringValue': event.__class__.__name__,
-                    },
-                    '_type': {
-                        'DataType': 'String',
-                        'StringValue': 'event'
-                    },
-                    '_context': {
-                        'DataType': 'String',
-                        'StringValue': event.get_context()
-                    },
-                }
-            )
+            self._sns_client.publish(TopicArn=topic_arn, **entry)
         except ClientError as e:
             raise ff.MessageBusError(str(e))
 
+    def begin(self):
+        self._buffering = True
+        self._events = []
+        self._commands = []
+
+    def flush(self):
+        events, self._events = self._events, []
+        commands, self._commands = self._commands, []
+        self._buffering = False
+
+        batches = []
+        for topic_arn, entries in self._group(events).items():
+            for batch in self._batch(entries, 'Message'):
+                batches.append((
+                    lambda e, t=topic_arn: self._publish_batch(t, e),
+                    batch
+                ))
+        for queue_url, entries in self._group(commands).items():
+            for batch in self._batch(entries, 'MessageBody'):
+                batches.append((
+                    lambda e, q=queue_url: self._sqs_client.send_message_batch(QueueUrl=q, Entries=e),
+                    batch
+                ))
+
+        if len(batches) == 0:
+            return
+
+        with ThreadPoolExecutor(max_workers=min(PUBLISH_CONCURRENCY, len(batches))) as executor:
+            failures = [f for f in executor.map(lambda b: self._send_batch(*b), batches) if f is not None]
+
+        if len(failures) > 0:
+            raise ff.MessageBusError(f'Failed to send {len(failures)} message batch(es): {failures}')
+
+    def discard(self):
+        self._events = []
+        self._commands = []
+        self._buffering = False
+
+    def _publish_batch(self, topic_arn: str, entries: List[dict]):
+        if hasattr(self._sns_client, 'publish_batch'):
+            return self._sns_client.publish_batch(TopicArn=topic_arn, PublishBatchRequestEntries=entries)
+
+        # PublishBatch only exists in botocore 1.23+; older clients publish one event at a time, reporting failures
+        # the way PublishBatch does.
+        failed = []
+        for entry in entries:
+            try:
+                self._sns_client.publish(TopicArn=topic_arn, **{k: v for k, v in entry.items() if k != 'Id'})
+            except ClientError as e:
+                error = e.response.get('Error', {})
+                failed.append({
+                    'Id': entry['Id'],
+                    'Code': error.get('Code'),
+                    'Message': error.get('Message'),
+                    'SenderFault': error.get('Type') == 'Sender',
+                })
+        return {'Failed': failed}
+
+    @staticmethod
+    def _group(messages: List[Tuple[str, dict]]):
+        ret = {}
+        for destination, entry in messages:
+            ret.setdefault(destination, []).append(entry)
+        return ret
+
+    def _batch(self, entries: List[dict], body_key: str):
+        batch, size = [], 0
+        for entry in entries:
+            entry_size = self._entry_size(entry, body_key)
+            if len(batch) == BATCH_SIZE or (len(batch) > 0 and size + entry_size > MAX_BATCH_BYTES):
+                yield batch
+                batch, size = [], 0
+            batch.append(entry)
+            size += entry_size
+        if len(batch) > 0:
+            yield batch
+
+    @staticmethod
+    def _entry_size(entry: dict, body_key: str) -> int:
+        # The limit is in bytes: the UTF-8 body plus each attribute's name, data type and value.
+        size = len(entry[body_key].encode('utf-8'))
+        for name, attribute in (entry.get('MessageAttributes') or {}).items():
+            value = attribute.get('StringValue', attribute.get('BinaryValue', b''))
+            size += len(name.encode('utf-8')) + len(attribute['DataType'].encode('utf-8')) + \
+                len(value.encode('utf-8') if isinstance(value, str) else value)
+        return size
+
+    @staticmethod
+    def _send_batch(send: Callable, entries: List[dict]):
+        pending = {str(i): entry for i, entry in enumerate(entries)}
+        errors = []
+
+        for attempt in range(PUBLISH_RETRIES):
+            if attempt > 0:
+                sleep(domain.jittered_backoff(attempt, base=PUBLISH_RETRY_WAIT))
+            try:
+                response = send([dict(Id=id_, **entry) for id_, entry in pending.items()])
+            except (ClientError, BotoCoreError) as e:
+                errors = [str(e)]
+                continue
+
+            # Only retry the entries that failed, and only if retrying could help.
+            retry = {}
+            errors = []
+            for failure in response.get('Failed') or []:
+                errors.append(f"{failure['Id']} {failure.get('Code')}: {failure.get('Message')}")
+                if not failure.get('SenderFault'):
+                    retry[failure['Id']] = pending[failure['Id']]
+            pending = retry
+            if len(pending) == 0:
+                break
+
+        return '; '.join(errors) if len(errors) > 0 else None
+
     def invoke(self, command: Command) -> Any:
         return self._invoke_lambda(command)
 
     def request(self, query: Query) -> Any:
         return self._invoke_lambda(query)
 
+    def invoke_many(self, commands: List[Command], return_exceptions: bool = False) -> List[Any]:
+        return self._fan_out(commands, return_exceptions)
+
+    def request_many(self, queries: List[Query], return_exceptions: bool = False) -> List[Any]:
+        return self._fan_out(queries, return_exceptions)
+
+    def _fan_out(self, messages: List[Union[Command, Query]], return_exceptions: bool):
+        """
+        Invokes the messages concurrently and returns their results in the same order. With return_exceptions,
+        failures are returned in place of their result instead of raising the first one. Unlike single messages,
+        which the resolving middleware only hands to the transport when they belong to another service, a batch may
+        mix in messages handled in this function. Those skip the network hop (and a second cold start) and run one
+        at a time on the calling thread while the remote ones are in flight, since the middleware stack
+        (transactions in particular) is not thread safe.
+        """
+        if len(messages) == 0:
+            return []
+
+        results = [None] * len(messages)
+        local = [self._is_handled_locally(message) for message in messages]
+
+        def invoke(i: int, message):
+            try:
+                return self._handle_locally(message) if local[i] else self._invoke_lambda(message)
+            except Exception as e:
+                if return_exceptions:
+                    return e
+                raise
+
+        remote = len(messages) - sum(local)
+
+        with ThreadPoolExecutor(max_workers=max(1, min(FAN_OUT_CONCURRENCY, remote))) as executor:
+            futures = [(i, executor.submit(invoke, i, m)) for i, m in enumerate(messages) if not local[i]]
+            for i, message in enumerate(messages):
+                if local[i]:
+                    results[i] = invoke(i, message)
+            for i, future in futures:
+                results[i] = future.result()
+
+        return results
+
     def _invoke_lambda(self, message: Union[Command, Query]):
         if hasattr(message, '_async') and getattr(message, '_async') is True:
             return self._invoke_async(message)
 
+        fire_and_forget = self._is_fire_and_forget(message)
+
+        payload = self._serializer.serialize(message)
+        if fire_and_forget:
+            # Event invocations are capped at 256 KB.
+            payload = self._store_large_payloads_in_s3(payload)
+
+        self._check_deadline()
         try:
-            response = ff.retry(
+            response = domain.retry_with_jitter(
                 lambda: self._lambda_client.invoke(
                     FunctionName=f'{self._service_name(message.get_context())}Sync',
-                    InvocationType='RequestResponse',
+                    InvocationType='Event' if fire_and_forget else 'RequestResponse',
                     LogType='None',
-                    Payload=self._serializer.serialize(message)
+                    Payload=payload
                 ),
-                wait=2
+                should_retry=self._should_retry
             )
         except ClientError as e:
             raise ff.MessageBusError(str(e))
 
+        if fire_and_forget:
+            return None
+
         ret = self._serializer.deserialize(response['Payload'].read().decode('utf-8'))
-        if isinstance(ret, dict) and 'PAYLOAD_KEY' in ret:
-            ret = self._load_payload(ret['PAYLOAD_KEY'])
+        if domain.LoadPayload.is_pointer(ret):
+            ret = self._load_payload(ret)
 
         return ret
 
+    @staticmethod
+    def _is_fire_and_forget(message: Union[Command, Query]):
+        return isinstance(message, Command) and message.headers.get(FIRE_AND_FORGET) is True
+
+    def _is_handled_locally(self, message: Union[Command, Query]):
+        if (hasattr(message, '_async') and getattr(message, '_async') is True) or self._is_fire_and_forget(message):
+            return False
+        # The same test the resolving middleware uses to decide whether a message leaves this function.
+        if self._context_map is None or self._context_map.get_context(message.get_context()) is None:
+            return False
+        if isinstance(message, Command):
+            return self._command_resolver is not None and self._command_resolver.has_command_handler(str(message))
+        return True
+
+    def _handle_locally(self, message: Union[Command, Query]):
+        """
+        Sends the message through the local bus, which runs the full middleware stack (transactions, authorization,
+        the outbox) before the resolving middleware calls the handler.
+        """
+        if isinstance(message, Command):
+            return self._kernel.invoke(message)
+        return self._kernel.request(message)
+
+    def _should_retry(self, err: Exception):
+        if isinstance(err, ClientError) and err.response.get('Error', {}).get('Code') not in RETRYABLE_LAMBDA_ERRORS:
+            return False
+        return self._has_time_for(RETRY_MIN_MILLIS)
+
     def _invoke_async(self, message: Command):
-        queue = self._sqs_resource.get_queue_by_name(QueueName=self._queue_name(message.get_context()))
-        queue.send_message(MessageBody=self._store_large_payloads_in_s3(self._serializer.serialize(message)))
+        queue_url = self._get_queue_url(message.get_context())
+        entry = {'MessageBody': self._store_large_payloads_in_s3(self._serializer.serialize(message))}
+
+        if self._buffering:
+            self._commands.append((queue_url, entry))
+            return
+
+        try:
+            self._sqs_client.send_message(QueueUrl=queue_url, **entry)
+        except ClientError as e:
+            raise ff.MessageBusError(str(e))
+
+    def _get_queue_url(self, context: str):
+        if context not in self._queue_urls:
+            if self._region is not None and self._account_id is not None:
+                self._queue_urls[context] = self._queue_url(context)
+            else:
+                self._queue_urls[context] = self._sqs_client.get_queue_url(
+                    QueueName=self._queue_name(context)
+                )['QueueUrl']
+
+        return self._queue_urls[context]
@@ -14,34 +14,41 @@
 
 from __future__ import annotations
 
-import gzip
 import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Union, Iterable, Iterator, BinaryIO
 
 import firefly as ff
 import firefly_aws.domain as awsd
-from botocore.exceptions import ClientError
 
+MIN_PART_SIZE = 5 * 1024 * 1024
+PART_SIZE = 8 * 1024 * 1024
+UPLOAD_CONCURRENCY = 4
+READ_SIZE = 1024 * 1024
 
-class BotoS3Service(awsd.S3Service, ff.LoggerAware):
+
+class BotoS3Service(awsd.S3Service, ff.LoggerAware, awsd.DeadlineAware):
     _configuration: ff.Configuration = None
     _s3_client = None
     _bucket: str = None
+    _s3_part_size: str = None
+    _s3_upload_concurrency: str = None
 
-    def store_download(self, data: str, extension: str = None, file_name: str = None, apply_compression: bool = True):
+    def store_download(self, data: Union[str, bytes, BinaryIO, Iterable[Union[str, bytes]]], extension: str = None,
+                       file_name: str = None, apply_compression: bool = True):
         key = file_name if file_name is not None else str(uuid.uuid4())
         content_encoding = None
         if extension is not None:
             key += f".{extension}"
 
         if apply_compression:
-            data = gzip.compress(data.encode('utf-8'))
             key += '.gz'
             content_encoding = 'gzip'
 
         key = f'/tmp/{key}'
 
         params = {
-            'Body': data,
             'Bucket': self._bucket,
             'Key': key,
         }
@@ -50,8 +57,93 @@ class BotoS3Service(awsd.S3Service, ff.LoggerAware):
                 'ContentEncoding': content_encoding,
             }
 
-        self._s3_client.put_object(**params)
+        self._upload(self._parts(self._chunks(data), apply_compression), params)
 
         return self._s3_client.generate_presigned_url(
             'get_object', Params={'Bucket': self._bucket, 'Key': key}
         )
+
+    @staticmethod
+    def _chunks(data) -> Iterator[bytes]:
+        if isinstance(data, str):
+            for i in range(0, len(data), READ_SIZE):
+                yield data[i:i + READ_SIZE].encode('utf-8')
+        elif isinstance(data, (bytes, bytearray)):
+            view = memoryview(data)
+            for i in range(0, len(view), READ_SIZE):
+                yield view[i:i + READ_SIZE]
+        elif hasattr(data, 'read'):
+            for chunk in iter(lambda: data.read(READ_SIZE), data.read(0)):
+                yield chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+        else:
+            for chunk in data:
+                yield chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+
+    def _parts(self, chunks: Iterator[bytes], apply_compression: bool) -> Iterator[bytes]:
+        compressor = zlib.compressobj(wbits=31) if apply_compression else None
+        part_size = max(int(self._s3_part_size or PART_SIZE), MIN_PART_SIZE)
+        buffer = bytearray()
+
+        for chunk in chunks:
+            buffer += compressor.compress(chunk) if compressor is not None else chunk
+            if len(buffer) >= part_size:
+                yield bytes(buffer)
+                buffer = bytearray()
+
+        if compressor is not None:
+            buffer += compressor.flush()
+        if len(buffer) > 0:
+            yield bytes(buffer)
+
+    def _upload(self, parts: Iterator[bytes], params: dict):
+        first = next(parts, b'')
+        second = next(parts, None)
+        if second is None:
+            # Everything fit in one part, so a single PUT is cheaper than a multipart upload.
+            self._s3_client.put_object(Body=first, **params)
+            return
+
+        upload_id = self._s3_client.create_multipart_upload(**params)['UploadId']
+        concurrency = max(1, int(self._s3_upload_concurrency or UPLOAD_CONCURRENCY))
+        futures = []
+
+        try:
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                pending = set()
+                for part_number, body in enumerate(self._prepend([first, second], parts), start=1):
+                    # Bound the number of parts held in memory to the number being uploaded.
+                    if len(pending) >= concurrency:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            future.result()  # Stop early if a part failed
+                    future = executor.submit(self._upload_part, params, upload_id, part_number, body)
+                    futures.append(future)
+                    pending.add(future)
+
+            self._s3_client.complete_multipart_upload(
+                Bucket=params['Bucket'],
+                Key=params['Key'],
+                UploadId=upload_id,
+                MultipartUpload={'Parts': [f.result() for f in futures]}
+            )
+        except Exception:
+            self._s3_client.abort_multipart_upload(Bucket=params['Bucket'], Key=params['Key'], UploadId=upload_id)
+            raise
+
+    @staticmethod
+    def _prepend(head: list, tail: Iterator):
+        yield from head
+        yield from tail
+
+    def _upload_part(self, params: dict, upload_id: str, part_number: int, body: bytes):
+        self._check_deadline()
+        self.debug('Uploading part %d of %s (%d bytes)', part_number, params['Key'], len(body))
+        response = self._s3_client.upload_part(
+            Bucket=params['Bucket'],
+            Key=params['Key'],
+            UploadId=upload_id,
+            PartNumber=part_number,
+            Body=body
+        )
+
+        return {'ETag': response['ETag'], 'PartNumber': part_number}
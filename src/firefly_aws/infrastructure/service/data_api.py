@@ -2,8 +2,10 @@ from __future__ import annotations
 
 import firefly as ff
 
+import firefly_aws.domain as domain
 
-class DataApi(ff.LoggerAware):
+
+class DataApi(ff.LoggerAware, domain.DeadlineAware):
     _rds_data_client = None
     _db_arn: str = None
     _db_secret_arn: str = None
@@ -19,6 +21,7 @@ class DataApi(ff.LoggerAware):
                 db_name: str = None):
         params = params or []
         self.info('%s - %s', sql, str(params))
+        self._check_deadline()
 
         return self._rds_data_client.execute_statement(
             resourceArn=(db_arn or self._db_arn),
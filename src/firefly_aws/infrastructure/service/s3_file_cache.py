@@ -0,0 +1,98 @@
+#  Copyright (c) 2020 JD Williams
+#
+#  This file is part of Firefly, a Python SOA framework built by JD Williams. Firefly is free software; you can
+#  redistribute it and/or modify it under the terms of the GNU General Public License as published by the
+#  Free Software Foundation; either version 3 of the License, or (at your option) any later version.
+#
+#  Firefly is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the
+#  implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+#  Public License for more details. You should have received a copy of the GNU Lesser General Public
+#  License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  You should have received a copy of the GNU General Public License along with Firefly. If not, see
+#  <http://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+
+class S3FileCache:
+    """
+    An LRU cache of S3 objects on local disk, for warm Lambda containers that read the same files repeatedly.
+    Entries are revalidated with their ETag, so the cache never serves stale content.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, bucket: str, key: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get((bucket, key))
+            if entry is not None:
+                self._entries.move_to_end((bucket, key))
+            return entry
+
+    def read(self, entry: dict) -> bytes:
+        with open(entry['path'], 'rb') as fp:
+            return fp.read()
+
+    def put(self, bucket: str, key: str, etag: str, content_type: Optional[str], data: bytes):
+        if etag is None or len(data) > self._max_bytes:
+            return
+
+        path = os.path.join(self._directory, hashlib.sha256(f'{bucket}/{key}'.encode('utf-8')).hexdigest())
+        # Write then rename, so a concurrent reader never sees a partial file.
+        tmp_path = f'{path}.{threading.get_ident()}'
+        with open(tmp_path, 'wb') as fp:
+            fp.write(data)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            previous = self._entries.pop((bucket, key), None)
+            if previous is not None:
+                self._bytes -= previous['size']
+            self._entries[(bucket, key)] = {
+                'etag': etag,
+                'content_type': content_type,
+                'size': len(data),
+                'path': path,
+            }
+            self._bytes += len(data)
+
+            while self._bytes > self._max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted['size']
+                try:
+                    os.remove(evicted['path'])
+                except FileNotFoundError:
+                    pass
+
+    def record(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / total if total > 0 else 0.0,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+            }
@@ -1,23 +1,55 @@
 from __future__ import annotations
 
-from typing import Tuple, List
+import json
+import mmap
+import os
+import queue
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple, List, Iterator, Union, Callable, Optional, BinaryIO
 
 import firefly as ff
 from botocore.exceptions import ClientError
 
+import firefly_aws.domain as domain
+from .s3_file_cache import S3FileCache
+from .s3_select_compiler import S3SelectCompiler
 
-class S3FileSystem(ff.FileSystem, ff.LoggerAware):
+LIST_CONCURRENCY = 16
+SELECT_CONCURRENCY = 16
+SCAN_RANGE_SIZE = 64 * 1024 * 1024
+SELECT_BATCH_SIZE = 500
+DOWNLOAD_PART_SIZE = 8 * 1024 * 1024
+DOWNLOAD_CONCURRENCY = 16
+READ_SIZE = 1024 * 1024
+DEFAULT_CACHE_DIR = '/tmp/s3-cache'
+_DONE = object()
+
+
+class S3FileSystem(ff.FileSystem, ff.LoggerAware, domain.DeadlineAware):
     _s3_client = None
     _bucket: str = None
+    _s3_cache_size: str = None
+    _s3_cache_dir: str = None
+
+    def __init__(self):
+        self._cache = None
+        self._compiler = S3SelectCompiler()
 
-    def read(self, file_name: str) -> ff.File:
+    def read(self, file_name: str, start: int = None, end: int = None) -> ff.File:
+        """
+        Reads a file, or only bytes start..end (inclusive) of it. Whole-file reads go through the local disk cache
+        when S3_CACHE_SIZE is set.
+        """
         bucket, file_name = self._parse_file_path(file_name)
-        try:
-            response = self._s3_client.get_object(Bucket=bucket, Key=file_name)
-        except self._s3_client.exceptions.NoSuchKey:
-            raise ff.NoSuchFile()
+        cache = self._get_cache()
+        if cache is not None and start is None and end is None:
+            content, content_type = self._read_cached(cache, bucket, file_name)
+        else:
+            response = self._get_object(bucket, file_name, start, end)
+            content, content_type = response['Body'].read(), response.get('ContentType', None)
 
-        content = response['Body'].read()
         try:
             content = content.decode('utf-8')
         except UnicodeDecodeError:
@@ -26,15 +58,105 @@ class S3FileSystem(ff.FileSystem, ff.LoggerAware):
         return ff.File(
             name=file_name,
             content=content,
-            content_type=response.get('ContentType', None)
+            content_type=content_type
         )
 
+    def cache_stats(self) -> Optional[dict]:
+        cache = self._get_cache()
+        return cache.stats() if cache is not None else None
+
+    def _get_cache(self) -> Optional[S3FileCache]:
+        if self._cache is None and self._s3_cache_size and int(self._s3_cache_size) > 0:
+            self._cache = S3FileCache(self._s3_cache_dir or DEFAULT_CACHE_DIR, int(self._s3_cache_size))
+        return self._cache
+
+    def _read_cached(self, cache: S3FileCache, bucket: str, key: str):
+        entry = cache.get(bucket, key)
+        params = {'IfNoneMatch': entry['etag']} if entry is not None else {}
+        self._check_deadline()
+        try:
+            response = self._s3_client.get_object(Bucket=bucket, Key=key, **params)
+        except self._s3_client.exceptions.NoSuchKey:
+            raise ff.NoSuchFile()
+        except ClientError as e:
+            if entry is None or e.response.get('Error', {}).get('Code') not in ('304', 'NotModified'):
+                raise
+            try:
+                content = cache.read(entry)
+            except FileNotFoundError:
+                # Evicted by another thread since we looked it up.
+                return self._read_cached(cache, bucket, key)
+            cache.record(hit=True)
+            self.debug('S3 cache hit for %s/%s: %s', bucket, key, cache.stats())
+            return content, entry['content_type']
+
+        cache.record(hit=False)
+        content = response['Body'].read()
+        cache.put(bucket, key, response.get('ETag'), response.get('ContentType', None), content)
+        return content, response.get('ContentType', None)
+
+    def open(self, file_name: str, start: int = None, end: int = None) -> BinaryIO:
+        """
+        A readable stream over the file (or a byte range of it) that downloads as it's read.
+        """
+        bucket, file_name = self._parse_file_path(file_name)
+        return self._get_object(bucket, file_name, start, end)['Body']
+
+    def download(self, file_name: str, part_size: int = DOWNLOAD_PART_SIZE,
+                 max_workers: int = DOWNLOAD_CONCURRENCY) -> Union[mmap.mmap, bytes]:
+        """
+        Downloads a file into a temporary file in /tmp with concurrent ranged GETs and returns it memory-mapped,
+        so large files can be processed without holding them in memory.
+        """
+        bucket, key = self._parse_file_path(file_name)
+        self._check_deadline()
+        try:
+            size = self._s3_client.head_object(Bucket=bucket, Key=key)['ContentLength']
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey'):
+                raise ff.NoSuchFile()
+            raise
+
+        if size == 0:
+            # Empty files can't be mapped.
+            return b''
+
+        with tempfile.TemporaryFile(dir='/tmp') as fp:
+            fp.truncate(size)
+            fd = fp.fileno()
+
+            def fetch(start: int):
+                body = self._get_object(bucket, key, start, min(start + part_size, size) - 1)['Body']
+                offset = start
+                for chunk in iter(lambda: body.read(READ_SIZE), b''):
+                    os.pwrite(fd, chunk, offset)
+                    offset += len(chunk)
+
+            with ThreadPoolExecutor(max_workers=max(1, min(max_workers, -(-size // part_size)))) as executor:
+                for future in [executor.submit(fetch, start) for start in range(0, size, part_size)]:
+                    future.result()
+
+            # The mapping keeps the data reachable after the (already unlinked) temp file is closed.
+            return mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+
+    def _get_object(self, bucket: str, key: str, start: int = None, end: int = None):
+        params = {}
+        if start is not None or end is not None:
+            params['Range'] = f"bytes={start or 0}-{'' if end is None else end}"
+
+        self._check_deadline()
+        try:
+            return self._s3_client.get_object(Bucket=bucket, Key=key, **params)
+        except self._s3_client.exceptions.NoSuchKey:
+            raise ff.NoSuchFile()
+
     def write(self, file: ff.File, path: str = None):
         path = '/'.join([(path or '').rstrip('/'), file.name])
         bucket, file_name = self._parse_file_path(path)
         params = {}
         if file.content_type is not None:
             params['ContentType'] = file.content_type
+        self._check_deadline()
         self._s3_client.put_object(
             Bucket=bucket,
             Key=file_name,
@@ -43,40 +165,238 @@ class S3FileSystem(ff.FileSystem, ff.LoggerAware):
         )
 
     def list(self, path: str) -> List[Tuple[str, dict]]:
-        bucket, file_name = self._parse_file_path(path)
-        params = {'Bucket': bucket, 'Prefix': file_name}
-        ret = []
+        return list(self.iter_list(path))
+
+    def iter_list(self, path: str, parallel: bool = False, delimiter: str = '/',
+                  max_workers: int = LIST_CONCURRENCY) -> Iterator[Tuple[str, dict]]:
+        """
+        Lazily lists the objects under a path. In parallel mode the keyspace is split by the sub-prefixes found
+        with the delimiter, those are listed concurrently, and objects are yielded in the order they arrive.
+        """
+        bucket, prefix = self._parse_file_path(path)
+        if not parallel:
+            for page in self._list_pages(bucket, prefix):
+                yield from self._list_items(bucket, page)
+            return
+
+        sub_prefixes = []
+        for page in self._list_pages(bucket, prefix, Delimiter=delimiter):
+            yield from self._list_items(bucket, page)
+            sub_prefixes.extend(p['Prefix'] for p in page.get('CommonPrefixes', []))
+
+        if len(sub_prefixes) == 0:
+            return
+
+        yield from self._merge(
+            [lambda p=sub_prefix: (list(self._list_items(bucket, page)) for page in self._list_pages(bucket, p))
+             for sub_prefix in sub_prefixes],
+            max_workers
+        )
+
+    def _merge(self, producers: List[Callable[[], Iterator[list]]], max_workers: int) -> Iterator:
+        """
+        Runs the producers on a thread pool and yields the items of the batches they produce as they arrive.
+        Closing the generator stops the producers at their next batch.
+        """
+        # Bounded, so a slow consumer holds back the producers instead of buffering everything in memory.
+        results = queue.Queue(maxsize=max_workers * 2)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    results.put(item, timeout=.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def run(producer: Callable[[], Iterator[list]]):
+            try:
+                if stop.is_set():
+                    return
+                for batch in producer():
+                    if stop.is_set():
+                        return
+                    put(batch)
+            except Exception as e:
+                put(e)
+            finally:
+                put(_DONE)
+
+        executor = ThreadPoolExecutor(max_workers=min(max_workers, len(producers)))
+        try:
+            for producer in producers:
+                executor.submit(run, producer)
+
+            remaining = len(producers)
+            while remaining > 0:
+                item = results.get()
+                if item is _DONE:
+                    remaining -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield from item
+        finally:
+            stop.set()
+            executor.shutdown(wait=False)
+
+    def _list_pages(self, bucket: str, prefix: str, **kwargs):
+        params = {'Bucket': bucket, 'Prefix': prefix, **kwargs}
 
         while True:
+            self._check_deadline()
             response = self._s3_client.list_objects_v2(**params)
-            if 'Contents' in response:
-                for item in response['Contents']:
-                    ret.append((f"{bucket}/{item['Key']}", {
-                        'size': item['Size'],
-                        'last_modified': item['LastModified'],
-                    }))
+            yield response
             if response['IsTruncated'] and 'NextContinuationToken' in response:
                 params['ContinuationToken'] = response['NextContinuationToken']
             else:
                 break
 
-        return ret
+    @staticmethod
+    def _list_items(bucket: str, page: dict):
+        for item in page.get('Contents', []):
+            yield f"{bucket}/{item['Key']}", {
+                'size': item['Size'],
+                'last_modified': item['LastModified'],
+            }
 
     def filter(self, path: str, fields: list, criteria: ff.BinaryOp):
+        """
+        The selected records as a JSON array, or '' if the select fails. Use iter_filter() to have errors raised.
+        """
+        try:
+            lines = [line.replace('\\r', '') for line in self._select_lines(path, fields, criteria)]
+        except ClientError as e:
+            self.exception('S3 Select on %s failed: %s', path, str(e))
+            return ''
+
+        return '[' + ','.join(lines) + ']'
+
+    def iter_filter(self, path: str, fields: list, criteria: ff.BinaryOp, batch_size: int = None) -> Iterator:
+        """
+        Yields the selected records as they stream in, or lists of up to batch_size records.
+        """
+        batch = []
+        try:
+            for line in self._select_lines(path, fields, criteria):
+                record = json.loads(line)
+                if batch_size is None:
+                    yield record
+                    continue
+                batch.append(record)
+                if len(batch) == batch_size:
+                    yield batch
+                    batch = []
+        except ClientError as e:
+            self.exception('S3 Select on %s failed: %s', path, str(e))
+            raise
+
+        if len(batch) > 0:
+            yield batch
+
+    def scan(self, path: Union[str, List[str]], fields: list, criteria: ff.BinaryOp, limit: int = None,
+             max_workers: int = SELECT_CONCURRENCY, scan_range_size: int = SCAN_RANGE_SIZE,
+             types: dict = None) -> Iterator:
+        """
+        Runs S3 Select concurrently over every object under a prefix (or in a list of paths), splitting large
+        uncompressed JSON lines objects into scan ranges, and yields records as they arrive. Outstanding work is
+        abandoned once limit records have been yielded. types are passed on to S3SelectCompiler.compile().
+        """
+        if isinstance(path, str):
+            objects = [(p, meta['size']) for p, meta in self.iter_list(path)]
+        else:
+            objects = [(p, None) for p in path]
+
+        producers = []
+        for object_path, size in objects:
+            for scan_range in self._scan_ranges(object_path, size, scan_range_size):
+                producers.append(
+                    lambda p=object_path, r=scan_range: self._batches(
+                        (json.loads(line) for line in self._select_lines(p, fields, criteria, r, types)),
+                        SELECT_BATCH_SIZE
+                    )
+                )
+
+        if len(producers) == 0:
+            return
+
+        count = 0
+        for record in self._merge(producers, max_workers):
+            yield record
+            count += 1
+            if limit is not None and count >= limit:
+                return
+
+    def _scan_ranges(self, path: str, size: Optional[int], scan_range_size: int):
+        # Only JSON lines can be split safely; CSV headers and quoted newlines, JSON documents and compressed or
+        # columnar files all need the object to be read from the start.
+        input_serialization = self._input_serialization(path.lower())
+        if input_serialization.get('JSON', {}).get('Type') != 'LINES' or \
+                input_serialization['CompressionType'] != 'NONE':
+            return [None]
+
+        if size is None:
+            bucket, key = self._parse_file_path(path)
+            size = self._s3_client.head_object(Bucket=bucket, Key=key)['ContentLength']
+
+        if size <= scan_range_size:
+            return [None]
+
+        # End is inclusive.
+        return [{'Start': start, 'End': min(start + scan_range_size, size) - 1}
+                for start in range(0, size, scan_range_size)]
+
+    @staticmethod
+    def _batches(items: Iterator, size: int) -> Iterator[list]:
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) == size:
+                yield batch
+                batch = []
+        if len(batch) > 0:
+            yield batch
+
+    def _select_lines(self, path: str, fields: list, criteria: ff.BinaryOp, scan_range: dict = None,
+                      types: dict = None) -> Iterator[str]:
         bucket, file_name = self._parse_file_path(path)
+        sql = self._compiler.compile(fields, criteria, types=types)
 
-        sql = f"select {', '.join(fields)} from s3object s"
-        if criteria is not None:
-            where, params = criteria.to_sql(prefix='s')
-            for k, v in params.items():
-                if isinstance(v, str):
-                    where = where.replace(f':{k}', f"'{v}'")
-                else:
-                    where = where.replace(f':{k}', str(v))
-            sql += f' where {where}'
+        params = {}
+        if scan_range is not None:
+            # S3 Select returns every record that starts inside the range, so adjacent ranges don't overlap.
+            params['ScanRange'] = scan_range
+
+        self._check_deadline()
+        response = self._s3_client.select_object_content(
+            Bucket=bucket,
+            Key=file_name,
+            InputSerialization=self._input_serialization(file_name.lower()),
+            OutputSerialization={'JSON': {}},
+            Expression=sql,
+            ExpressionType='SQL',
+            **params
+        )
+
+        # Records are newline delimited, but event-stream chunks don't respect record (or UTF-8) boundaries, so
+        # hold back whatever follows the last newline until the next chunk arrives.
+        remainder = b''
+        for event in response['Payload']:
+            if 'Records' not in event:
+                continue
+            lines = (remainder + event['Records']['Payload']).split(b'\n')
+            remainder = lines.pop()
+            for line in lines:
+                if line.strip():
+                    yield line.decode('utf-8')
+
+        if remainder.strip():
+            yield remainder.decode('utf-8')
 
+    @staticmethod
+    def _input_serialization(fn: str):
         compression = 'NONE'
-        fn = file_name.lower()
         if fn.endswith('.bz2'):
             compression = 'BZIP2'
         elif fn.endswith('.gz'):
@@ -87,6 +407,10 @@ class S3FileSystem(ff.FileSystem, ff.LoggerAware):
         }
         if '.parquet' in fn:
             input_serialization['Parquet'] = {}
+        elif '.jsonl' in fn or '.ndjson' in fn:
+            input_serialization['JSON'] = {
+                'Type': 'LINES',
+            }
         elif '.json' in fn:
             input_serialization['JSON'] = {
                 'Type': 'DOCUMENT',
@@ -96,25 +420,7 @@ class S3FileSystem(ff.FileSystem, ff.LoggerAware):
                 'FileHeaderInfo': 'Use',
             }
 
-        try:
-            response = self._s3_client.select_object_content(
-                Bucket=bucket,
-                Key=file_name,
-                InputSerialization=input_serialization,
-                OutputSerialization={'JSON': {}},
-                Expression=sql,
-                ExpressionType='SQL'
-            )
-        except ClientError as e:
-            print(e)
-            return ''
-
-        ret = '['
-        for event in response['Payload']:
-            if 'Records' in event:
-                ret += event['Records']['Payload'].decode('utf-8').replace("\n", ",").replace('\\r', '')
-
-        return ret.rstrip(',') + ']'
+        return input_serialization
 
     def _parse_file_path(self, path: str):
         parts = path.lstrip('/').split('/')
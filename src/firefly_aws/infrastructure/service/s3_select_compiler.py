@@ -0,0 +1,175 @@
+#  Copyright (c) 2020 JD Williams
+#
+#  This file is part of Firefly, a Python SOA framework built by JD Williams. Firefly is free software; you can
+#  redistribute it and/or modify it under the terms of the GNU General Public License as published by the
+#  Free Software Foundation; either version 3 of the License, or (at your option) any later version.
+#
+#  Firefly is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the
+#  implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+#  Public License for more details. You should have received a copy of the GNU Lesser General Public
+#  License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  You should have received a copy of the GNU General Public License along with Firefly. If not, see
+#  <http://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+
+import math
+import re
+from datetime import date, datetime
+from functools import lru_cache
+from typing import List, Optional
+
+import firefly as ff
+
+# A field name, or a dotted path to a nested one.
+_IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)*$')
+
+
+class S3SelectCompiler:
+    """
+    Compiles search criteria into S3 Select SQL. Values are escaped and rendered as literals (S3 Select has no bind
+    parameters), and the SQL template for each criteria shape is built once and reused.
+
+    S3 Select reads CSV fields, and JSON values such as ISO dates, as strings. Pass types (field -> SQL type, e.g.
+    {'created': 'TIMESTAMP', 'count': 'INT'}) to CAST those fields before they are compared.
+    """
+
+    def compile(self, fields: List[str], criteria: Optional[ff.BinaryOp] = None, alias: str = 's',
+                types: dict = None) -> str:
+        sql = f'select {self._projection(tuple(fields), alias)} from s3object {alias}'
+        if criteria is None:
+            return sql
+
+        values = []
+        shape = self._shape(criteria, values, types or {})
+        return f'{sql} where ' + _template(shape, alias).format(*map(self._literal, values))
+
+    @staticmethod
+    @lru_cache(maxsize=64)
+    def _projection(fields: tuple, alias: str) -> str:
+        if len(fields) == 0 or '*' in fields:
+            return '*'
+        # Only field names are quoted. Expressions such as count(*) or CAST(...), and paths that already start
+        # with the alias (s.id), are passed through as written.
+        return ', '.join(
+            _identifier(field, alias) if _IDENTIFIER.match(field) and not field.startswith(f'{alias}.') else field
+            for field in fields
+        )
+
+    def _shape(self, value, values: list, types: dict):
+        """
+        The structure of the criteria without its values, which are appended to values in template order.
+        """
+        if isinstance(value, ff.BinaryOp):
+            if value.op == 'is':
+                return 'is', self._shape(value.lhv, values, types), _is_operand(value.rhv)
+            if value.op in ('contains', 'startswith', 'endswith'):
+                return 'op', value.op, self._shape(value.lhv, values, types), \
+                    self._shape(_LikePattern(value), values, types)
+            return 'op', value.op, self._shape(value.lhv, values, types), self._shape(value.rhv, values, types)
+
+        if isinstance(value, ff.Attr):
+            value = value.attr
+        if isinstance(value, ff.AttributeString):
+            return 'attr', str(value), tuple(value.get_modifiers() or ()), types.get(str(value))
+
+        if isinstance(value, (list, tuple, set)):
+            values.extend(value)
+            return 'list', len(value)
+
+        values.append(value)
+        return 'value',
+
+    @staticmethod
+    def _literal(value) -> str:
+        if isinstance(value, _LikePattern):
+            return _quote(str(value))
+        if value is None:
+            return 'null'
+        if isinstance(value, bool):
+            return 'true' if value else 'false'
+        if isinstance(value, int):
+            return str(value)
+        if isinstance(value, float):
+            if math.isnan(value) or math.isinf(value):
+                raise ff.InvalidArgument(f'Cannot compare against {value} in S3 Select')
+            return repr(value)
+        if isinstance(value, (datetime, date)):
+            return f"CAST({_quote(value.isoformat())} AS TIMESTAMP)"
+        return _quote(str(value))
+
+
+def _quote(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _identifier(name: str, alias: str) -> str:
+    return '.'.join([alias] + ['"' + part.replace('"', '""') + '"' for part in name.split('.')])
+
+
+def _is_operand(value) -> str:
+    if value is None or value == 'null':
+        return 'NULL'
+    return 'true' if value is True else 'false'
+
+
+class _LikePattern:
+    def __init__(self, criteria: ff.BinaryOp):
+        escaped = str(criteria.rhv).replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        self._pattern = {
+            'contains': f'%{escaped}%',
+            'startswith': f'{escaped}%',
+            'endswith': f'%{escaped}',
+        }[criteria.op]
+
+    def __str__(self):
+        return self._pattern
+
+
+@lru_cache(maxsize=256)
+def _template(shape: tuple, alias: str) -> str:
+    return _render(shape, alias, [0])
+
+
+def _render(shape: tuple, alias: str, position: list) -> str:
+    kind = shape[0]
+    if kind == 'attr':
+        _, name, modifiers, type_ = shape
+        ret = _identifier(name, alias).replace('{', '{{').replace('}', '}}')
+        if type_ is not None:
+            ret = f'CAST({ret} AS {type_})'
+        for modifier in reversed(modifiers):
+            ret = f'{modifier}({ret})'
+        return ret
+
+    if kind == 'value':
+        position[0] += 1
+        return '{' + str(position[0] - 1) + '}'
+
+    if kind == 'list':
+        placeholders = []
+        for _ in range(shape[1]):
+            placeholders.append('{' + str(position[0]) + '}')
+            position[0] += 1
+        return f"({', '.join(placeholders)})"
+
+    if kind == 'is':
+        lhv = _render(shape[1], alias, position)
+        return f'({lhv} IS NULL)' if shape[2] == 'NULL' else f'({lhv} = {shape[2]})'
+
+    _, op, lhs, rhs = shape
+    lhv = _render(lhs, alias, position)
+    rhv = _render(rhs, alias, position)
+    if op in ('contains', 'startswith', 'endswith'):
+        return f"({lhv} LIKE {rhv} ESCAPE '\\')"
+    if op in ('and', 'or'):
+        return f'({lhv} {op.upper()} {rhv})'
+    if op == 'in':
+        # IN () is not valid SQL, and nothing is in an empty list.
+        return '(1 = 0)' if rhs == ('list', 0) else f'({lhv} IN {rhv})'
+
+    operators = {'==': '=', '!=': '<>', '>': '>', '>=': '>=', '<': '<', '<=': '<='}
+    if op not in operators:
+        raise ff.LogicError(f"Don't know how to handle op: {op}")
+    return f'({lhv} {operators[op]} {rhv})'
@@ -0,0 +1,62 @@
+import json
+import os
+from time import perf_counter
+
+import pytest
+
+from fake_s3 import FakeS3Client
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+MB = 1024 * 1024
+RESULTS = []
+
+
+def pytest_collection_modifyitems(config, items):
+    if os.environ.get('FF_BENCHMARK'):
+        return
+
+    skip = pytest.mark.skip(reason='Set FF_BENCHMARK=1 to run benchmarks')
+    for item in items:
+        if str(item.fspath).startswith(BENCHMARK_DIR):
+            item.add_marker(skip)
+
+
+def pytest_sessionfinish(session, exitstatus):
+    # FF_BENCHMARK_OUTPUT=results.json keeps the numbers so runs can be compared over time.
+    output = os.environ.get('FF_BENCHMARK_OUTPUT')
+    if output and RESULTS:
+        with open(output, 'w') as fp:
+            json.dump(RESULTS, fp, indent=2)
+
+
+@pytest.fixture()
+def disk_s3_client(tmp_path):
+    return FakeS3Client(root=str(tmp_path / 's3'))
+
+
+@pytest.fixture()
+def stopwatch(request):
+    def _stopwatch(label: str, cb, iterations: int = 5, size: int = None, items: int = None):
+        """
+        Times cb, after a warm up call. Pass the bytes (size) or records (items) each call handles to also report
+        throughput.
+        """
+        cb()  # warm up
+        start = perf_counter()
+        for _ in range(iterations):
+            ret = cb()
+        elapsed = (perf_counter() - start) / iterations
+
+        result = {'test': request.node.nodeid, 'label': label, 'ms': round(elapsed * 1000, 3)}
+        line = f'{label}: {elapsed * 1000:.2f} ms'
+        if size is not None:
+            result['mb_per_s'] = round(size / MB / elapsed, 2)
+            line += f' ({result["mb_per_s"]:.1f} MB/s)'
+        if items is not None:
+            result['items_per_s'] = round(items / elapsed, 1)
+            line += f' ({result["items_per_s"]:,.0f}/s)'
+        RESULTS.append(result)
+        print(line)
+        return elapsed, ret
+
+    return _stopwatch
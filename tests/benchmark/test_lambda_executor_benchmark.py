@@ -0,0 +1,35 @@
+import json
+
+import firefly.infrastructure as ffi
+import pytest
+from firefly_aws.domain import LambdaExecutor, StoreLargePayloadsInS3
+
+
+@pytest.fixture()
+def sut(s3_client):
+    serializer = ffi.JsonSerializer()
+    store = StoreLargePayloadsInS3()
+    store._s3_client = s3_client
+    store._serializer = serializer
+    store._bucket = 'bucket'
+
+    ret = LambdaExecutor()
+    ret._serializer = serializer
+    ret._store_large_payloads_in_s3 = store
+
+    return ret
+
+
+@pytest.mark.parametrize('size', [10 * 1024, 1024 * 1024, 5 * 1024 * 1024])
+def test_direct_response(size, sut, stopwatch):
+    row = {'id': '5d2b9bca-7d49-4a8a-9d57-7c1d2f37b2d1', 'name': 'x' * 64, 'count': 42}
+    result = [dict(row) for _ in range(size // len(json.dumps(row)))]
+
+    def round_trip():
+        return sut._serializer.deserialize(sut._store_large_payloads_in_s3(sut._serializer.serialize(result)))
+
+    old, _ = stopwatch(f'serialize/deserialize round trip ({size} bytes)', round_trip)
+    new, ret = stopwatch(f'direct response ({size} bytes)', lambda: sut._direct_response(result))
+
+    assert ret == result
+    print(f'speedup: {old / new:.1f}x')
@@ -0,0 +1,82 @@
+import json
+import random
+import string
+from contextlib import closing
+
+import firefly.infrastructure as ffi
+import pytest
+from firefly_aws.domain import StoreLargePayloadsInS3, LoadPayload, compression
+
+from fake_s3 import FakeS3Client
+
+
+@pytest.fixture()
+def serializer():
+    return ffi.JsonSerializer()
+
+
+def payload(size: int):
+    words = [''.join(random.choices(string.ascii_lowercase, k=8)) for _ in range(500)]
+    rows = []
+    while len(rows) * 64 < size:
+        rows.append({'id': len(rows), 'name': ' '.join(random.choices(words, k=5))})
+    return json.dumps(rows)
+
+
+@pytest.mark.parametrize('codec', [compression.GZIP, compression.BZ2, compression.ZSTD, compression.NONE])
+@pytest.mark.parametrize('size', [128 * 1024, 1024 * 1024, 8 * 1024 * 1024])
+def test_offload_round_trip(codec, size, s3_client, serializer, stopwatch):
+    if codec == compression.ZSTD and compression.zstandard is None:
+        pytest.skip('zstandard is not installed')
+
+    store = StoreLargePayloadsInS3()
+    store._s3_client = s3_client
+    store._serializer = serializer
+    store._bucket = 'bucket'
+    store._payload_codec = codec
+
+    load = LoadPayload()
+    load._s3_client = s3_client
+    load._serializer = serializer
+    load._bucket = 'bucket'
+
+    data = payload(size)
+    _, pointer = stopwatch(f'{codec} store ({size} bytes)', lambda: store(data), size=size)
+    _, ret = stopwatch(f'{codec} load ({size} bytes)', lambda: load(serializer.deserialize(pointer)), size=size)
+
+    tier = 'inline' if 'PAYLOAD_INLINE' in pointer else 's3'
+    print(f'{codec} ({size} bytes): {tier}, {len(pointer)} bytes on the wire')
+    assert ret == json.loads(data)
+
+
+@pytest.mark.parametrize('codec', [compression.GZIP, compression.NONE])
+def test_stream_offloaded_payload(codec, serializer, stopwatch, tmp_path):
+    s3_client = FakeS3Client(root=str(tmp_path), latency=.02, bandwidth=100 * 1024 * 1024)
+    size = 32 * 1024 * 1024
+    store = StoreLargePayloadsInS3()
+    store._s3_client = s3_client
+    store._serializer = serializer
+    store._bucket = 'bucket'
+    store._payload_codec = codec
+    data = payload(size)
+    pointer = serializer.deserialize(store(data))
+
+    load = LoadPayload()
+    load._s3_client = s3_client
+    load._serializer = serializer
+    load._bucket = 'bucket'
+    load._payload_cache_size = '1'  # Measure S3, not the in-memory cache
+
+    def drain():
+        with closing(load.open(pointer).open()) as stream:
+            read = 0
+            while True:
+                chunk = stream.read(1024 * 1024)
+                if not chunk:
+                    return read
+                read += len(chunk)
+
+    _, read = stopwatch(f'{codec} stream 32 MB payload', drain, iterations=3, size=size)
+    stopwatch(f'{codec} load 32 MB payload', lambda: load(pointer), iterations=3, size=size)
+
+    assert read == len(data.encode('utf-8'))
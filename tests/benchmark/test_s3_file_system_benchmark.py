@@ -0,0 +1,94 @@
+import os
+
+import firefly as ff
+import pytest
+from firefly_aws.infrastructure import S3FileSystem
+
+from fake_s3 import FakeS3Client
+
+MB = 1024 * 1024
+
+
+@pytest.fixture(scope='module')
+def s3_client():
+    ret = FakeS3Client()
+    for day in range(30):
+        for i in range(2000):
+            ret.put_object(Bucket='bucket', Key=f'events/2021-06-{day + 1:02d}/{i:06d}.json', Body=b'{}')
+    ret.latency = .02
+    return ret
+
+
+@pytest.fixture()
+def sut(s3_client, logger):
+    ret = S3FileSystem()
+    ret._logger = logger
+    ret._s3_client = s3_client
+    return ret
+
+
+@pytest.mark.parametrize('parallel', [False, True])
+def test_list(parallel, sut, stopwatch):
+    _, ret = stopwatch(
+        f'list 60,000 keys (parallel={parallel})',
+        lambda: list(sut.iter_list('bucket/events/', parallel=parallel)),
+        iterations=1,
+        items=60_000
+    )
+
+    assert len(ret) == 60_000
+
+
+@pytest.mark.parametrize('max_workers', [1, 16])
+def test_download(max_workers, stopwatch, logger):
+    s3_client = FakeS3Client(latency=.02, bandwidth=50 * 1024 * 1024)
+    data = os.urandom(256 * 1024 * 1024)
+    s3_client.put_object(Bucket='bucket', Key='large.bin', Body=data)
+    sut = S3FileSystem()
+    sut._logger = logger
+    sut._s3_client = s3_client
+
+    _, ret = stopwatch(
+        f'download 256 MB, {max_workers} worker(s)',
+        lambda: sut.download('bucket/large.bin', max_workers=max_workers),
+        iterations=1,
+        size=len(data)
+    )
+
+    assert ret[:1024] == data[:1024] and len(ret) == len(data)
+
+
+@pytest.mark.parametrize('cache_size', [None, str(64 * 1024 * 1024)])
+def test_warm_reads(cache_size, stopwatch, tmp_path, logger):
+    s3_client = FakeS3Client(latency=.02, bandwidth=50 * 1024 * 1024)
+    s3_client.put_object(Bucket='bucket', Key='model.bin', Body=os.urandom(16 * 1024 * 1024))
+    sut = S3FileSystem()
+    sut._logger = logger
+    sut._s3_client = s3_client
+    sut._s3_cache_size = cache_size
+    sut._s3_cache_dir = str(tmp_path)
+
+    stopwatch(
+        f'read 16 MB (cache={cache_size is not None})', lambda: sut.read('bucket/model.bin'), iterations=10,
+        size=16 * MB
+    )
+    print(sut.cache_stats())
+
+
+@pytest.mark.parametrize('size', [MB, 16 * MB, 128 * MB])
+def test_write_and_ranged_read(size, disk_s3_client, stopwatch, logger):
+    disk_s3_client.latency = .02
+    disk_s3_client.bandwidth = 50 * MB
+    sut = S3FileSystem()
+    sut._logger = logger
+    sut._s3_client = disk_s3_client
+    file = ff.File(name='blob.bin', content=os.urandom(size), content_type='application/octet-stream')
+
+    stopwatch(f'write {size // MB} MB', lambda: sut.write(file, 'bucket/blobs'), iterations=1, size=size)
+    stopwatch(
+        f'read last MB of {size // MB} MB', lambda: sut.read('bucket/blobs/blob.bin', start=size - MB, end=size - 1),
+        size=MB
+    )
+    _, ret = stopwatch(f'read {size // MB} MB', lambda: sut.read('bucket/blobs/blob.bin'), iterations=1, size=size)
+
+    assert ret.content == file.content
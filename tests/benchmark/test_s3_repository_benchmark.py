@@ -0,0 +1,126 @@
+import firefly as ff
+import firefly.infrastructure as ffi
+import pytest
+from firefly_aws.infrastructure import S3Repository
+
+
+class Widget(ff.AggregateRoot):
+    id: str = ff.id_()
+    name: str = ff.required(index=True)
+    count: int = ff.optional(default=0, index=True)
+    description: str = ff.optional()
+
+
+@pytest.fixture(scope='module')
+def sut(logger):
+    from fake_s3 import FakeS3Client
+
+    class Widgets(S3Repository[Widget]):
+        pass
+
+    ret = Widgets(FakeS3Client(), ffi.JsonSerializer(), 'bucket')
+    ret._logger = logger
+    ret.append([Widget(name=f'widget-{i % 100}', count=i, description='x' * 1024) for i in range(2000)])
+    ret.commit()
+    ret._s3_client.latency = .01
+    return ret
+
+
+def test_filter_by_indexed_field(sut, stopwatch):
+    def filter_():
+        sut.reset()
+        return sut.filter(lambda w: w.name == 'widget-7')
+
+    _, ret = stopwatch('filter 2,000 widgets by an indexed field', filter_)
+
+    assert len(ret) == 20
+
+
+def test_find_many(sut, stopwatch):
+    ids = sut._matching_ids(None)[:500]
+
+    def find_many():
+        sut.reset()
+        return sut.find_many(ids)
+
+    def find_serially():
+        sut.reset()
+        return [sut.find(id_) for id_ in ids]
+
+    stopwatch('find() 500 widgets one at a time', find_serially, iterations=1, items=len(ids))
+    _, ret = stopwatch('find_many() 500 widgets', find_many, items=len(ids))
+
+    assert [w.id for w in ret] == ids
+
+
+def test_len(sut, stopwatch):
+    _, ret = stopwatch('len() of 2,000 widgets', lambda: len(sut))
+
+    assert ret == 2000
+
+
+def test_commit_writes_concurrently_and_skips_unchanged(stopwatch, logger):
+    from fake_s3 import FakeS3Client
+
+    class Widgets(S3Repository[Widget]):
+        pass
+
+    client = FakeS3Client()
+    client.latency = .01
+    sut = Widgets(client, ffi.JsonSerializer(), 'bucket')
+    sut._logger = logger
+    sut.append([Widget(name=f'widget-{i}', count=i) for i in range(500)])
+    stopwatch('commit 500 new widgets', sut.commit, items=500)
+
+    sut.reset()
+    loaded = list(sut)
+    loaded[0].count = -1
+    puts = []
+    put_object = client.put_object
+    client.put_object = lambda **kwargs: puts.append(kwargs['Key']) or put_object(**kwargs)
+    stopwatch('commit 1 change among 500 loaded widgets', sut.commit)
+
+    assert [key for key in puts if '/_index/' not in key] == [sut._key(loaded[0].id)]
+
+    sut.remove(loaded)
+    sut.commit()
+
+    assert len(sut) == 0
+
+
+def test_conditional_writes_detect_concurrent_updates(stopwatch, logger):
+    from concurrent.futures import ThreadPoolExecutor
+    from fake_s3 import FakeS3Client
+
+    class Widgets(S3Repository[Widget]):
+        pass
+
+    client = FakeS3Client()
+    first, second = Widgets(client, ffi.JsonSerializer(), 'bucket'), Widgets(client, ffi.JsonSerializer(), 'bucket')
+    first._logger = second._logger = logger
+    widget = Widget(name='widget', count=0)
+    first.append(widget)
+    first.commit()
+
+    second.find(widget.id).count = 2
+    first.find(widget.id).count = 1
+    first.commit()
+    with pytest.raises(ff.ConcurrentUpdateDetected):
+        second.commit()
+
+    client.latency = .002
+
+    def writer(n: int):
+        repo = Widgets(client, ffi.JsonSerializer(), 'bucket')
+        repo._logger = logger
+        repo.append([Widget(name=f'writer-{n}', count=i) for i in range(20)])
+        repo.commit()
+
+    def contend():
+        with ThreadPoolExecutor(max_workers=10) as executor:
+            list(executor.map(writer, range(10)))
+
+    stopwatch('10 writers committing 20 widgets each', contend, iterations=1)
+
+    first.reset()
+    assert len(first) == 1 + 2 * 10 * 20
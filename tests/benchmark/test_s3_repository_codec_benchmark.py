@@ -0,0 +1,96 @@
+import random
+import string
+from datetime import datetime, timedelta
+from typing import List
+
+import firefly as ff
+import firefly.infrastructure as ffi
+import pytest
+from firefly_aws.domain import compression, encoding
+from firefly_aws.infrastructure import S3Repository
+
+CODECS = ['json', 'json+gzip', 'json+zstd', 'msgpack', 'msgpack+zstd', 'cbor', 'cbor+zstd']
+
+
+class LineItem(ff.ValueObject):
+    sku: str = ff.required()
+    quantity: int = ff.required()
+    price: float = ff.required()
+    shipped_at: datetime = ff.optional()
+
+
+class Order(ff.AggregateRoot):
+    id: str = ff.id_()
+    customer: str = ff.required(index=True)
+    placed_at: datetime = ff.required()
+    items: List[LineItem] = ff.list_()
+
+
+def order(n_items: int = 2000):
+    start = datetime(2021, 1, 1)
+    return Order(
+        customer=''.join(random.choices(string.ascii_lowercase, k=12)),
+        placed_at=start,
+        items=[LineItem(
+            sku=''.join(random.choices(string.ascii_uppercase + string.digits, k=10)), quantity=random.randint(1, 9),
+            price=round(random.uniform(1, 500), 2), shipped_at=start + timedelta(minutes=i)
+        ) for i in range(n_items)]
+    )
+
+
+def skip_if_unavailable(codec: str):
+    fmt, compression_codec = encoding.parse_codec(codec)
+    if (fmt == encoding.MSGPACK and encoding.msgpack is None) or (fmt == encoding.CBOR and encoding.cbor2 is None):
+        pytest.skip(f'{fmt} is not installed')
+    if compression_codec == compression.ZSTD and compression.zstandard is None:
+        pytest.skip('zstandard is not installed')
+
+
+@pytest.mark.parametrize('codec', CODECS)
+def test_encode_decode(codec, stopwatch, logger):
+    skip_if_unavailable(codec)
+    from fake_s3 import FakeS3Client
+
+    class Orders(S3Repository[Order]):
+        pass
+
+    sut = Orders(FakeS3Client(), ffi.JsonSerializer(), 'bucket', codec=codec)
+    sut._logger = logger
+    data = order().to_dict()
+    key = sut._key('x')
+
+    _, body = stopwatch(f'{codec} encode', lambda: sut._encode(data))
+    _, ret = stopwatch(f'{codec} decode', lambda: sut._decode(body if isinstance(body, bytes) else body.encode(), key))
+    print(f'{codec} size: {len(body) / 1024:.1f} KiB')
+
+    assert Order.from_dict(ret).to_dict() == data
+
+
+@pytest.mark.parametrize('codec', CODECS)
+def test_repository_round_trip(codec, stopwatch, logger):
+    skip_if_unavailable(codec)
+    from fake_s3 import FakeS3Client
+
+    class Orders(S3Repository[Order]):
+        pass
+
+    client = FakeS3Client()
+    orders = [order(200) for _ in range(50)]
+    writer = Orders(client, ffi.JsonSerializer(), 'bucket')
+    writer._logger = logger
+    writer.append(orders[:25])
+    writer.commit()
+
+    # Half the aggregates predate the codec and are stored as JSON.
+    sut = Orders(client, ffi.JsonSerializer(), 'bucket', codec=codec)
+    sut._logger = logger
+    sut.append(orders[25:])
+    sut.commit()
+
+    def load():
+        sut.reset()
+        return sut.find_many([o.id for o in orders])
+
+    _, ret = stopwatch(f'{codec} find_many 50 orders', load)
+
+    assert [o.to_dict() for o in ret] == [o.to_dict() for o in orders]
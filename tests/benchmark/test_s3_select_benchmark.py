@@ -0,0 +1,58 @@
+import pytest
+from firefly_aws.infrastructure import S3FileSystem
+
+from fake_s3 import FakeS3Client
+
+MB = 1024 * 1024
+
+
+def csv_body(size: int):
+    header = 'id,name,count\n'
+    row = '5d2b9bca-7d49-4a8a-9d57-7c1d2f37b2d1,widget ünïcödé,42\n'
+    return (header + row * (size // len(row.encode('utf-8')))).encode('utf-8')
+
+
+@pytest.mark.parametrize('size', [100 * MB, 1024 * MB])
+def test_filter(size, disk_s3_client, stopwatch, logger):
+    s3_client = disk_s3_client
+    s3_client.put_object(Bucket='bucket', Key='widgets.csv', Body=csv_body(size))
+    sut = S3FileSystem()
+    sut._logger = logger
+    sut._s3_client = s3_client
+
+    def consume():
+        count = 0
+        for _ in sut.iter_filter('bucket/widgets.csv', ['*'], None):
+            count += 1
+        return count
+
+    _, count = stopwatch(f'iter_filter {size // MB} MB', consume, iterations=1, size=size)
+    stopwatch(
+        f'filter {size // MB} MB', lambda: sut.filter('bucket/widgets.csv', ['*'], None), iterations=1, size=size
+    )
+    print(f'{count} records')
+
+
+@pytest.mark.parametrize('max_workers', [1, 16])
+def test_scan(max_workers, stopwatch, logger):
+    s3_client = FakeS3Client()
+    row = b'{"id": "5d2b9bca-7d49-4a8a-9d57-7c1d2f37b2d1", "name": "widget", "count": 42}\n'
+    for partition in range(100):
+        s3_client.put_object(Bucket='bucket', Key=f'lake/day={partition:03d}/data.jsonl', Body=row * 20_000)
+    s3_client.latency = .02
+    sut = S3FileSystem()
+    sut._logger = logger
+    sut._s3_client = s3_client
+
+    _, count = stopwatch(
+        f'scan 100 objects, {max_workers} worker(s)',
+        lambda: sum(1 for _ in sut.scan('bucket/lake/', ['*'], None, max_workers=max_workers, scan_range_size=MB)),
+        iterations=1,
+        items=2_000_000
+    )
+    stopwatch(
+        f'scan with limit, {max_workers} worker(s)',
+        lambda: list(sut.scan('bucket/lake/', ['*'], None, limit=100, max_workers=max_workers)),
+        iterations=1
+    )
+    assert count == 2_000_000
@@ -0,0 +1,52 @@
+import gzip
+
+import pytest
+from firefly_aws.infrastructure import BotoS3Service
+
+from fake_s3 import FakeS3Client
+
+MB = 1024 * 1024
+
+
+def csv_rows(size: int):
+    row = '5d2b9bca-7d49-4a8a-9d57-7c1d2f37b2d1,widget,42,2021-06-01T00:00:00\n'
+    rows = ''.join(row for _ in range(MB // len(row)))
+    for _ in range(size // len(rows)):
+        yield rows
+
+
+@pytest.mark.parametrize('size', [50 * MB, 200 * MB, 500 * MB])
+@pytest.mark.parametrize('concurrency', [1, 4, 8])
+def test_store_download(size, concurrency, stopwatch, logger):
+    # Simulate a round trip per request so parallel part uploads have something to overlap.
+    s3_client = FakeS3Client(latency=.05)
+    sut = BotoS3Service()
+    sut._logger = logger
+    sut._s3_client = s3_client
+    sut._bucket = 'bucket'
+    sut._s3_part_size = str(5 * MB)
+    sut._s3_upload_concurrency = str(concurrency)
+
+    _, url = stopwatch(
+        f'store_download {size // MB} MB, concurrency {concurrency}',
+        lambda: sut.store_download(csv_rows(size), extension='csv', file_name='export', apply_compression=False),
+        iterations=1,
+        size=size
+    )
+
+    print(f'{s3_client.calls.get("upload_part", 0)} part uploads')
+    assert url.endswith('export.csv')
+
+
+def test_compressed_upload_round_trips(logger):
+    s3_client = FakeS3Client()
+    sut = BotoS3Service()
+    sut._logger = logger
+    sut._s3_client = s3_client
+    sut._bucket = 'bucket'
+    sut._s3_part_size = str(5 * MB)
+
+    data = ''.join(csv_rows(50 * MB))
+    sut.store_download(data, file_name='export')
+
+    assert gzip.decompress(s3_client.body('bucket', '/tmp/export.gz')).decode('utf-8') == data
@@ -0,0 +1,16 @@
+import firefly.infrastructure as ffi
+import pytest
+
+from fake_s3 import FakeS3Client
+
+
+@pytest.fixture()
+def s3_client():
+    return FakeS3Client()
+
+
+@pytest.fixture(scope='session')
+def logger():
+    ret = ffi.PythonLogger()
+    ret._serializer = ffi.JsonSerializer()
+    return ret
@@ -0,0 +1,303 @@
+import bz2
+import csv
+import gzip
+import hashlib
+import io
+import json
+import os
+import threading
+import uuid
+from datetime import datetime
+from time import sleep
+from typing import Optional
+
+from botocore.exceptions import ClientError
+
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+class FakeBody(io.BytesIO):
+    pass
+
+
+class NoSuchKey(ClientError):
+    def __init__(self, operation: str):
+        super().__init__({'Error': {'Code': 'NoSuchKey', 'Message': 'NoSuchKey'}}, operation)
+
+
+class FakeS3Client:
+    """
+    A thread safe stand-in for the boto3 S3 client covering the calls this package makes. Objects live in memory,
+    or as files under `root` (e.g. a directory in /tmp) for data sets that shouldn't be held in memory. `latency` is
+    added to every call and `bandwidth` (bytes/s, per connection) to every transfer, so concurrency shows up in
+    benchmarks the way it does against S3. `max_keys` caps list pages to exercise pagination with few objects, and
+    `select_chunk_size` sets how S3 Select payloads are split into events.
+    """
+
+    class exceptions:
+        NoSuchKey = NoSuchKey
+
+    def __init__(self, latency: float = 0, bandwidth: float = None, root: str = None, max_keys: int = 1000,
+                 min_part_size: int = MIN_PART_SIZE, select_chunk_size: int = 64 * 1024):
+        self.objects = {}
+        self.calls = {}
+        self.uploads = {}
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.root = root
+        self.max_keys = max_keys
+        self.min_part_size = min_part_size
+        self.select_chunk_size = select_chunk_size
+        self._lock = threading.Lock()
+
+    def put_object(self, Bucket: str, Key: str, Body, **kwargs):
+        self._count('put_object')
+        if isinstance(Body, str):
+            Body = Body.encode('utf-8')
+        elif hasattr(Body, 'read'):
+            Body = Body.read()
+        Body = bytes(Body)
+        self._transfer(len(Body))
+        return self._put(Bucket, Key, Body, **kwargs)
+
+    def get_object(self, Bucket: str, Key: str, Range: str = None, IfNoneMatch: str = None, **kwargs):
+        self._count('get_object')
+        obj = self._get(Bucket, Key)
+        if IfNoneMatch is not None and IfNoneMatch == obj['ETag']:
+            raise ClientError({'Error': {'Code': '304', 'Message': 'Not Modified'}}, 'GetObject')
+        start, end = 0, None
+        if Range is not None:
+            start, end = Range[len('bytes='):].split('-')
+            start, end = int(start), int(end) + 1 if end else None
+        body = self.body(Bucket, Key, start, end)
+        self._transfer(len(body))
+        return {
+            'Body': FakeBody(body),
+            'ContentLength': len(body),
+            'ContentType': obj['ContentType'],
+            'ETag': obj['ETag'],
+            'Metadata': obj['Metadata'],
+        }
+
+    def head_object(self, Bucket: str, Key: str, **kwargs):
+        self._count('head_object')
+        if (Bucket, Key) not in self.objects:
+            # HEAD responses have no body, so S3 reports a bare 404 rather than NoSuchKey.
+            raise ClientError({'Error': {'Code': '404', 'Message': 'Not Found'}}, 'HeadObject')
+        obj = self._get(Bucket, Key)
+        return {
+            'ContentLength': obj['ContentLength'],
+            'ContentType': obj['ContentType'],
+            'ETag': obj['ETag'],
+            'LastModified': obj['LastModified'],
+            'Metadata': obj['Metadata'],
+        }
+
+    def delete_object(self, Bucket: str, Key: str, **kwargs):
+        self._count('delete_object')
+        with self._lock:
+            self._discard(self.objects.pop((Bucket, Key), None))
+        return {}
+
+    def delete_objects(self, Bucket: str, Delete: dict, **kwargs):
+        self._count('delete_objects')
+        assert len(Delete['Objects']) <= 1000
+        with self._lock:
+            for obj in Delete['Objects']:
+                self._discard(self.objects.pop((Bucket, obj['Key']), None))
+        return {'Deleted': [{'Key': obj['Key']} for obj in Delete['Objects']]}
+
+    def list_objects_v2(self, Bucket: str, Prefix: str = '', Delimiter: str = None, MaxKeys: int = 1000,
+                        ContinuationToken: str = None, StartAfter: str = None, **kwargs):
+        self._count('list_objects_v2')
+        max_keys = min(MaxKeys, self.max_keys)
+        keys = sorted(k for b, k in list(self.objects) if b == Bucket and k.startswith(Prefix))
+        after = ContinuationToken or StartAfter
+        if after is not None:
+            keys = [k for k in keys if k > after]
+
+        contents, prefixes = [], []
+        for key in keys:
+            if len(contents) + len(prefixes) == max_keys:
+                break
+            if Delimiter is not None and Delimiter in key[len(Prefix):]:
+                prefix = key[:key.index(Delimiter, len(Prefix)) + len(Delimiter)]
+                if prefix not in prefixes:
+                    prefixes.append(prefix)
+                continue
+            obj = self.objects[(Bucket, key)]
+            contents.append({
+                'Key': key, 'Size': obj['ContentLength'], 'LastModified': obj['LastModified'], 'ETag': obj['ETag']
+            })
+
+        ret = {'IsTruncated': False, 'KeyCount': len(contents) + len(prefixes)}
+        if contents:
+            ret['Contents'] = contents
+        if prefixes:
+            ret['CommonPrefixes'] = [{'Prefix': p} for p in prefixes]
+        last = max([c['Key'] for c in contents] + [p + '\uffff' for p in prefixes], default=None)
+        if last is not None and any(k > last for k in keys):
+            ret['IsTruncated'] = True
+            ret['NextContinuationToken'] = last
+        return ret
+
+    def select_object_content(self, Bucket: str, Key: str, InputSerialization: dict, OutputSerialization: dict = None,
+                              ScanRange: dict = None, **kwargs):
+        """
+        Ignores the expression and returns every record of a CSV, JSON lines or JSON document object (within
+        ScanRange) as JSON lines or CSV, in chunks that split records at arbitrary points like the real event
+        stream does.
+        """
+        self._count('select_object_content')
+        chunk_size = self.select_chunk_size
+        self._get(Bucket, Key)
+        body = self.body(Bucket, Key)
+        compression = InputSerialization.get('CompressionType', 'NONE')
+        if compression == 'GZIP':
+            body = gzip.decompress(body)
+        elif compression == 'BZIP2':
+            body = bz2.decompress(body)
+        output_csv = 'CSV' in (OutputSerialization or {})
+        stats = {'BytesScanned': 0, 'BytesProcessed': 0, 'BytesReturned': 0}
+
+        def csv_line(row: dict):
+            buffer = io.StringIO()
+            csv.writer(buffer, lineterminator='').writerow(row.values())
+            return buffer.getvalue().encode('utf-8')
+
+        def records():
+            if 'CSV' in InputSerialization:
+                header = InputSerialization['CSV'].get('FileHeaderInfo', 'NONE').upper()
+                reader = csv.reader(io.TextIOWrapper(io.BytesIO(body), encoding='utf-8'))
+                columns = next(reader) if header in ('USE', 'IGNORE') else None
+                for values in reader:
+                    if header == 'USE':
+                        yield dict(zip(columns, values))
+                    else:
+                        yield {f'_{i + 1}': v for i, v in enumerate(values)}
+                stats['BytesScanned'] = stats['BytesProcessed'] = len(body)
+                return
+
+            if InputSerialization.get('JSON', {}).get('Type') == 'DOCUMENT':
+                stats['BytesScanned'] = stats['BytesProcessed'] = len(body)
+                yield json.loads(body)
+                return
+
+            start = ScanRange['Start'] if ScanRange else 0
+            end = ScanRange['End'] if ScanRange else len(body) - 1
+            # Records belong to the range they start in.
+            offset = body.rfind(b'\n', 0, start) + 1 if start > 0 else 0
+            if offset < start:
+                offset = body.find(b'\n', start) + 1 if body.find(b'\n', start) >= 0 else len(body)
+            while offset <= end and offset < len(body):
+                newline = body.find(b'\n', offset)
+                newline = len(body) if newline < 0 else newline
+                if body[offset:newline].strip():
+                    stats['BytesScanned'] += newline + 1 - offset
+                    yield json.loads(body[offset:newline])
+                offset = newline + 1
+            stats['BytesProcessed'] = stats['BytesScanned']
+
+        def payload():
+            buffer = bytearray()
+            for record in records():
+                buffer += (csv_line(record) if output_csv else json.dumps(record, ensure_ascii=False).encode('utf-8')) + b'\n'
+                while len(buffer) >= chunk_size:
+                    stats['BytesReturned'] += chunk_size
+                    yield {'Records': {'Payload': bytes(buffer[:chunk_size])}}
+                    del buffer[:chunk_size]
+            if buffer:
+                stats['BytesReturned'] += len(buffer)
+                yield {'Records': {'Payload': bytes(buffer)}}
+            yield {'Stats': {'Details': dict(stats)}}
+            yield {'End': {}}
+
+        return {'Payload': payload()}
+
+    def create_multipart_upload(self, Bucket: str, Key: str, **kwargs):
+        self._count('create_multipart_upload')
+        upload_id = str(uuid.uuid4())
+        with self._lock:
+            self.uploads[upload_id] = {'parts': {}, 'kwargs': kwargs}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket: str, Key: str, UploadId: str, PartNumber: int, Body, **kwargs):
+        self._count('upload_part')
+        Body = bytes(Body)
+        self._transfer(len(Body))
+        with self._lock:
+            self.uploads[UploadId]['parts'][PartNumber] = Body
+        return {'ETag': f'"{hashlib.md5(Body).hexdigest()}"'}
+
+    def complete_multipart_upload(self, Bucket: str, Key: str, UploadId: str, MultipartUpload: dict):
+        self._count('complete_multipart_upload')
+        with self._lock:
+            upload = self.uploads.pop(UploadId)
+        parts = [upload['parts'][p['PartNumber']] for p in MultipartUpload['Parts']]
+        if any(len(part) < self.min_part_size for part in parts[:-1]):
+            raise ClientError({'Error': {'Code': 'EntityTooSmall', 'Message': 'Your proposed upload is smaller than '
+                               'the minimum allowed object size.'}}, 'CompleteMultipartUpload')
+        return self._put(Bucket, Key, b''.join(parts), **upload['kwargs'])
+
+    def abort_multipart_upload(self, Bucket: str, Key: str, UploadId: str):
+        self._count('abort_multipart_upload')
+        with self._lock:
+            self.uploads.pop(UploadId, None)
+
+    def generate_presigned_url(self, operation: str, Params: dict, **kwargs):
+        return f"https://{Params['Bucket']}.s3.amazonaws.com/{Params['Key'].lstrip('/')}"
+
+    def body(self, bucket: str, key: str, start: int = 0, end: Optional[int] = None) -> bytes:
+        obj = self._get(bucket, key)
+        if 'Body' in obj:
+            return obj['Body'][start:end]
+        with open(obj['Path'], 'rb') as fp:
+            fp.seek(start)
+            return fp.read(-1 if end is None else max(0, end - start))
+
+    def _put(self, bucket: str, key: str, body: bytes, **kwargs):
+        with self._lock:
+            current = self.objects.get((bucket, key))
+            if ('IfMatch' in kwargs and (current is None or current['ETag'] != kwargs['IfMatch'])) or \
+                    (kwargs.get('IfNoneMatch') == '*' and current is not None):
+                raise ClientError({'Error': {'Code': 'PreconditionFailed', 'Message': 'At least one of the '
+                                   'pre-conditions you specified did not hold'}}, 'PutObject')
+            self.objects[(bucket, key)] = {
+                **self._store(bucket, key, body),
+                'ContentLength': len(body),
+                'LastModified': datetime.now(),
+                'Metadata': kwargs.get('Metadata', {}),
+                'ContentType': kwargs.get('ContentType'),
+                'ETag': f'"{hashlib.md5(body).hexdigest()}"',
+            }
+            return {'ETag': self.objects[(bucket, key)]['ETag']}
+
+    def _store(self, bucket: str, key: str, body: bytes) -> dict:
+        if self.root is None:
+            return {'Body': body}
+        path = os.path.join(self.root, bucket, hashlib.sha256(key.encode('utf-8')).hexdigest())
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as fp:
+            fp.write(body)
+        return {'Path': path}
+
+    @staticmethod
+    def _discard(obj: Optional[dict]):
+        if obj is not None and 'Path' in obj and os.path.exists(obj['Path']):
+            os.remove(obj['Path'])
+
+    def _get(self, bucket: str, key: str):
+        if (bucket, key) not in self.objects:
+            raise NoSuchKey('GetObject')
+        return self.objects[(bucket, key)]
+
+    def _transfer(self, size: int):
+        if self.bandwidth:
+            # Per-connection bandwidth, so concurrent requests add up like they do against S3.
+            sleep(size / self.bandwidth)
+
+    def _count(self, operation: str):
+        with self._lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+        if self.latency:
+            sleep(self.latency)
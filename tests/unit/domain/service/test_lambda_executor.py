@@ -1,12 +1,209 @@
+import base64
+import gzip
+import io
+import json
+import os
+from datetime import datetime
+from time import sleep
+from unittest.mock import MagicMock
+
+import firefly as ff
 import pytest
-from firefly_aws.domain import LambdaExecutor
+from firefly_aws.domain import LambdaExecutor, LambdaTimedOut
+from firefly_aws.domain.service import lambda_executor
+from firefly_aws.domain.service.lambda_executor import time_limit, Base64Reader, MAX_RESPONSE_BODY_SIZE
 from firefly_aws.application import Container
 import firefly.infrastructure as ff_infra
 
 
+class WidgetCreated(ff.Event):
+    _context = 'widgets'
+
+
+class Context:
+    def __init__(self, remaining_millis: int):
+        self.remaining_millis = remaining_millis
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining_millis
+
+
 @pytest.fixture()
 def sut():
     ret = Container().mock(LambdaExecutor)
     ret._serializer = ff_infra.JsonSerializer()
+    ret._serializer._message_factory = ff.MessageFactory()
 
     return ret
+
+
+def test_the_hard_limit_keeps_a_proportional_reserve(sut):
+    assert sut._hard_limit_millis(Context(60000)) == 54000
+    assert sut._hard_limit_millis(Context(3000)) == 2000
+    assert sut._hard_limit_millis(Context(1200)) == 200
+
+
+def test_there_is_no_hard_limit_when_the_reserve_uses_up_the_remaining_time(sut):
+    assert sut._hard_limit_millis(Context(1000)) is None
+    assert sut._hard_limit_millis(Context(500)) is None
+
+
+def test_the_deadline_comes_before_the_hard_limit(sut):
+    assert sut._get_deadline(Context(60000)).remaining_millis() <= 54000 * .9
+    assert sut._get_deadline(Context(1000)).remaining_millis() <= 1000 * .9
+    assert sut._get_deadline(None) is None
+
+
+def test_time_limit_interrupts_work():
+    with pytest.raises(LambdaTimedOut):
+        with time_limit(.05):
+            sleep(1)
+
+
+def test_unhandled_sqs_records_are_reported_as_failures(sut):
+    records = [
+        {'messageId': str(i), 'eventSource': 'aws:sqs', 'body': sut._serializer.serialize(WidgetCreated())}
+        for i in range(3)
+    ]
+    sut._kernel.deadline = MagicMock()
+    sut._kernel.deadline.expired.side_effect = [False, False, True]
+    sut.nack_message = MagicMock()
+    sut.complete_batch_handshake = MagicMock()
+
+    response = sut._handle_sqs_event({'Records': records})
+
+    assert response == {'batchItemFailures': [{'itemIdentifier': '2'}]}
+    sut.nack_message.assert_called_once_with(records[2])
+    sut.complete_batch_handshake.assert_called_once_with(records[:2])
+
+
+@pytest.fixture()
+def http_sut(sut):
+    sut._kernel.http_request = {'headers': {}}
+    sut._response_compression_threshold = None
+    sut._max_compressible_body_size = None
+    sut._s3_service = MagicMock()
+    sut._s3_service.store_download.return_value = 'https://bucket/download'
+    return sut
+
+
+def test_small_responses_are_returned_inline(http_sut):
+    ret = http_sut._handle_http_response({'widgets': ['a', 'b']})
+
+    assert ret['statusCode'] == 200
+    assert json.loads(ret['body']) == {'widgets': ['a', 'b']}
+    http_sut._s3_service.store_download.assert_not_called()
+
+
+def test_responses_over_the_lambda_limit_are_offloaded_to_s3(http_sut):
+    items = ['x' * 1000] * (MAX_RESPONSE_BODY_SIZE // 1000)
+
+    ret = http_sut._handle_http_response(items)
+
+    assert ret['statusCode'] == 303
+    assert ret['headers']['Location'] == 'https://bucket/download'
+    body = http_sut._s3_service.store_download.call_args[0][0]
+    assert json.loads(''.join(body)) == items
+
+
+def test_escaping_is_counted_towards_the_limit(http_sut):
+    # Fits as serialized, but not once the runtime escapes the quotes again.
+    items = ['"' * 100] * (MAX_RESPONSE_BODY_SIZE // 250)
+
+    assert http_sut._handle_http_response(items)['statusCode'] == 303
+
+
+@pytest.mark.parametrize('accept, expected', [
+    (None, None),
+    ('', None),
+    ('gzip', 'gzip'),
+    ('gzip, deflate, br', 'br'),
+    ('br;q=0.5, gzip;q=0.8', 'gzip'),
+    ('gzip;q=0, br;q=0', None),
+    ('*', 'br'),
+    ('*;q=0.1, gzip;q=0', 'br'),
+    ('identity;q=0', None),
+    ('deflate', None),
+    ('GZIP;q=abc, br;q=0.2', 'br'),
+])
+def test_content_encoding_negotiation(sut, accept, expected):
+    pytest.importorskip('brotli')
+    sut._kernel.http_request = {'headers': {'Accept-Encoding': accept} if accept is not None else {}}
+
+    assert sut._negotiate_content_encoding() == expected
+
+
+def test_gzip_is_negotiated_without_brotli(sut, monkeypatch):
+    monkeypatch.setattr(lambda_executor, 'brotli', None)
+    sut._kernel.http_request = {'headers': {'accept-encoding': 'br, gzip;q=0.5'}}
+
+    assert sut._negotiate_content_encoding() == 'gzip'
+
+
+def test_large_responses_are_compressed(http_sut):
+    http_sut._kernel.http_request = {'headers': {'Accept-Encoding': 'gzip'}}
+    items = ['widget'] * 10000
+
+    ret = http_sut._handle_http_response(items)
+
+    assert ret['isBase64Encoded'] is True
+    assert ret['headers']['Content-Encoding'] == 'gzip'
+    assert json.loads(gzip.decompress(base64.b64decode(ret['body']))) == items
+
+
+def test_redirects_drop_the_compressed_response_headers(http_sut):
+    http_sut._kernel.http_request = {'headers': {'Accept-Encoding': 'gzip'}}
+    # Still over the limit once compressed and base64 encoded
+    body = base64.b64encode(os.urandom(6 * 1024 * 1024)).decode('ascii')
+
+    ret = http_sut._handle_http_response(body)
+
+    assert ret['statusCode'] == 303
+    assert ret['isBase64Encoded'] is False
+    assert 'Content-Encoding' not in ret['headers']
+    assert 'Vary' not in ret['headers']
+    assert ret['headers']['Location'] == 'https://bucket/download'
+
+
+def test_direct_responses_are_json_compatible(sut):
+    sut._store_large_payloads_in_s3 = MagicMock()
+    sut._store_large_payloads_in_s3.store.return_value = None
+
+    assert sut._direct_response(None) is None
+    assert sut._direct_response(3) == 3
+    assert sut._direct_response({'created': datetime(2021, 6, 1), 'widgets': ['a']}) == \
+        {'created': '2021-06-01T00:00:00', 'widgets': ['a']}
+
+
+def test_large_direct_responses_are_stored_in_s3(sut):
+    sut._store_large_payloads_in_s3 = MagicMock()
+    sut._store_large_payloads_in_s3.store.return_value = 'tmp/key.json.gz'
+
+    assert sut._direct_response({'widgets': ['a']}) == {'PAYLOAD_KEY': 'tmp/key.json.gz'}
+    sut._store_large_payloads_in_s3.store.assert_called_once_with('{"widgets": ["a"]}', limit=MAX_RESPONSE_BODY_SIZE)
+
+
+@pytest.mark.parametrize('size', [0, 1, 2, 3, 1000, 64 * 1024 + 1])
+@pytest.mark.parametrize('block_size', [4, 7, 1024])
+def test_base64_reader_decodes_incrementally(size, block_size):
+    data = os.urandom(size)
+    reader = io.BufferedReader(Base64Reader(base64.b64encode(data).decode('ascii'), block_size=block_size))
+
+    chunks = list(iter(lambda: reader.read(333), b''))
+
+    assert b''.join(chunks) == data
+
+
+def test_multipart_bodies_are_parsed_from_base64(sut):
+    sut._multipart_memfile_limit = None
+    body = (
+        b'--b\r\nContent-Disposition: form-data; name="title"\r\n\r\nwidget\r\n'
+        b'--b\r\nContent-Disposition: form-data; name="file"; filename="w.bin"\r\n'
+        b'Content-Type: application/octet-stream\r\n\r\n' + bytes(range(256)) + b'\r\n--b--\r\n'
+    )
+
+    ret = sut._parse_multipart('multipart/form-data; boundary=b', base64.b64encode(body).decode('ascii'))
+
+    assert ret['title'] == 'widget'
+    assert ret['file'].name == 'w.bin'
+    assert ret['file'].content == bytes(range(256))
@@ -0,0 +1,162 @@
+import json
+import random
+import string
+from contextlib import closing
+from datetime import timedelta
+
+import firefly.infrastructure as ffi
+import pytest
+from firefly_aws.domain import StoreLargePayloadsInS3, LoadPayload
+from firefly_aws.domain.service import store_large_payloads_in_s3 as store_module
+
+
+@pytest.fixture()
+def store(s3_client):
+    ret = StoreLargePayloadsInS3()
+    ret._s3_client = s3_client
+    ret._serializer = ffi.JsonSerializer()
+    ret._bucket = 'bucket'
+    ret._payload_codec = 'gzip'
+    return ret
+
+
+@pytest.fixture()
+def load(s3_client):
+    ret = LoadPayload()
+    ret._s3_client = s3_client
+    ret._serializer = ffi.JsonSerializer()
+    ret._bucket = 'bucket'
+    return ret
+
+
+def test_small_payloads_are_passed_through(store, s3_client):
+    payload = json.dumps({'x': 'y'})
+
+    assert store(payload) == payload
+    assert len(s3_client.objects) == 0
+
+
+def test_compressible_payloads_are_inlined(store, load, s3_client):
+    data = {'rows': ['x' * 100] * 1000}
+    pointer = json.loads(store(json.dumps(data)))
+
+    assert pointer['PAYLOAD_CODEC'] == 'gzip'
+    assert len(s3_client.objects) == 0
+    assert load(pointer) == data
+
+
+def test_payloads_keep_the_old_wire_format_by_default(store, s3_client):
+    store._payload_codec = None
+    data = {'rows': ['x' * 100] * 1000}
+    pointer = json.loads(store(json.dumps(data)))
+
+    # A plain JSON object under a .json key, which consumers deployed before compression can still read.
+    assert list(pointer.keys()) == ['PAYLOAD_KEY']
+    assert pointer['PAYLOAD_KEY'].endswith('.json')
+    assert json.loads(s3_client.body('bucket', pointer['PAYLOAD_KEY'])) == data
+
+
+def test_the_codec_is_configured_not_detected(store, load, s3_client):
+    pytest.importorskip('zstandard')
+    data = {'rows': ['x' * 100] * 1000}
+
+    store._payload_codec = 'zstd'
+    pointer = json.loads(store(json.dumps(data)))
+
+    assert pointer['PAYLOAD_CODEC'] == 'zstd'
+    assert load(pointer) == data
+
+
+def test_incompressible_payloads_are_stored_in_s3(store, load, s3_client):
+    data = {'rows': ''.join(random.choices(string.ascii_letters, k=400_000))}
+    pointer = json.loads(store(json.dumps(data)))
+
+    assert pointer['PAYLOAD_KEY'].endswith('.json.gz')
+    assert load(pointer) == data
+    assert load(pointer['PAYLOAD_KEY']) == data
+
+
+def test_identical_payloads_are_stored_once(store, load, s3_client):
+    data = json.dumps({'rows': ''.join(random.choices(string.ascii_letters, k=400_000))})
+    first = json.loads(store(data))
+
+    fresh = StoreLargePayloadsInS3()
+    fresh._s3_client = s3_client
+    fresh._serializer = ffi.JsonSerializer()
+    fresh._bucket = 'bucket'
+    fresh._payload_codec = 'gzip'
+
+    assert json.loads(store(data)) == first
+    assert json.loads(fresh(data)) == first
+    assert s3_client.calls['put_object'] == 1
+    assert s3_client.calls['head_object'] == 2
+
+    load(first)
+    load(first)
+    assert s3_client.calls['get_object'] == 1
+
+
+def test_stale_payloads_are_written_again(store, s3_client, monkeypatch):
+    data = json.dumps({'rows': ''.join(random.choices(string.ascii_letters, k=400_000))})
+    now = 1000.
+    monkeypatch.setattr(store_module, 'monotonic', lambda: now)
+    key = json.loads(store(data))['PAYLOAD_KEY']
+
+    # Another process finds the object close to the age limit and writes it again, resetting its expiration.
+    s3_client.objects[('bucket', key)]['LastModified'] -= timedelta(seconds=store_module.DEDUP_MAX_AGE)
+    now += store_module.DEDUP_MAX_AGE
+    assert json.loads(store(data))['PAYLOAD_KEY'] == key
+    assert s3_client.calls['put_object'] == 2
+
+    now += 1
+    assert json.loads(store(data))['PAYLOAD_KEY'] == key
+    assert s3_client.calls['put_object'] == 2
+
+
+def test_large_payloads_are_streamed(store, load):
+    data = {'rows': ''.join(random.choices(string.ascii_letters, k=400_000))}
+    pointer = json.loads(store(json.dumps(data)))
+    load._payload_streaming_threshold = '1024'
+
+    assert load(pointer) == data
+    with closing(load.open(pointer).open()) as stream:
+        assert json.load(stream) == data
+
+
+class StreamingBody:
+    """
+    Like botocore's StreamingBody before 1.20: readable and closable, but not a context manager.
+    """
+
+    def __init__(self, body):
+        self._body = body
+        self.closed = False
+
+    def read(self, amt=None):
+        return self._body.read(amt)
+
+    def close(self):
+        self.closed = True
+
+
+def test_uncompressed_payloads_are_streamed_from_plain_bodies(store, load, s3_client):
+    pytest.importorskip('ijson')
+    store._payload_codec = 'none'
+    data = {'rows': [{'n': i} for i in range(10000)]}
+    pointer = json.loads(store(json.dumps(data)))
+    load._payload_streaming_threshold = '1024'
+
+    bodies = []
+    get_object = s3_client.get_object
+
+    def _get_object(**kwargs):
+        ret = get_object(**kwargs)
+        ret['Body'] = StreamingBody(ret['Body'])
+        bodies.append(ret['Body'])
+        return ret
+
+    s3_client.get_object = _get_object
+
+    assert load(pointer) == data
+    assert [row['n'] for row in load.open(pointer).items('rows.item')] == list(range(10000))
+    assert all(body.closed for body in bodies)
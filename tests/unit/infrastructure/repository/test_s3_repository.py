@@ -0,0 +1,359 @@
+from datetime import datetime
+from typing import List
+
+import boto3
+import firefly as ff
+import firefly.infrastructure as ffi
+import pytest
+from botocore.awsrequest import AWSResponse
+from botocore.exceptions import ClientError
+from firefly_aws.domain import encoding
+from firefly_aws.infrastructure import S3Repository, S3FileSystem
+
+
+class Widget(ff.AggregateRoot):
+    id: str = ff.id_()
+    name: str = ff.required(index=True)
+    count: int = ff.optional(default=0, index=True)
+    created: datetime = ff.optional(index=True)
+    description: str = ff.optional()
+
+
+class Widgets(S3Repository[Widget]):
+    pass
+
+
+class Part(ff.ValueObject):
+    sku: str = ff.required()
+    price: float = ff.required()
+    shipped_at: datetime = ff.optional()
+
+
+class Order(ff.AggregateRoot):
+    id: str = ff.id_()
+    customer: str = ff.required(index=True)
+    placed_at: datetime = ff.required()
+    parts: List[Part] = ff.list_()
+
+
+class Orders(S3Repository[Order]):
+    pass
+
+
+@pytest.fixture()
+def repository(s3_client, logger):
+    def _repository(**kwargs):
+        ret = Widgets(s3_client, ffi.JsonSerializer(), 'bucket', **kwargs)
+        ret._logger = logger
+        return ret
+
+    return _repository
+
+
+@pytest.fixture()
+def sut(repository):
+    return repository()
+
+
+@pytest.fixture()
+def widgets(sut):
+    ret = [Widget(name=f'widget-{i}', count=i) for i in range(3)]
+    sut.append(ret)
+    sut.commit()
+    sut.reset()
+    return ret
+
+
+def fail_puts(s3_client, key_part: str, code: str = 'InternalError'):
+    put_object = s3_client.put_object
+
+    def _put_object(**kwargs):
+        if key_part in kwargs['Key']:
+            raise ClientError({'Error': {'Code': code, 'Message': code}}, 'PutObject')
+        return put_object(**kwargs)
+
+    s3_client.put_object = _put_object
+
+
+def stored(s3_client):
+    # Index rows may come back in a different order, and a shard emptied by a rollback is the same as none.
+    ret = {key: sorted(s3_client.body(bucket, key).splitlines()) for bucket, key in s3_client.objects}
+    return {key: lines for key, lines in ret.items() if len(lines) > 0}
+
+
+def test_commit_skips_unchanged_aggregates(sut, widgets, s3_client):
+    loaded = sut.find_many([w.id for w in widgets])
+    loaded[0].count = 10
+    puts = s3_client.calls['put_object']
+    sut.commit()
+
+    # The changed aggregate and its index shard
+    assert s3_client.calls['put_object'] - puts == 2
+    sut.reset()
+    assert sut.find(widgets[0].id).count == 10
+
+
+def test_unindexed_changes_leave_the_index_alone(sut, widgets, s3_client):
+    sut.find(widgets[0].id).description = 'changed'
+    puts = s3_client.calls['put_object']
+    sut.commit()
+
+    assert s3_client.calls['put_object'] - puts == 1
+
+
+def test_shards_are_read_once_per_unit_of_work(sut, widgets, s3_client):
+    gets = s3_client.calls['get_object']
+    assert len(sut) == 3
+    assert len(list(sut)) == 3
+    assert len(sut.filter(lambda w: w.count > 0)) == 2
+
+    # 16 shards and the 3 aggregates
+    assert s3_client.calls['get_object'] - gets == 16 + 3
+
+    sut.reset()
+    assert len(sut) == 3
+    assert s3_client.calls['get_object'] - gets == 2 * 16 + 3
+
+
+def test_failed_commit_is_rolled_back(sut, widgets, s3_client):
+    before = stored(s3_client)
+    loaded = sut.find_many([w.id for w in widgets])
+    for widget in loaded:
+        widget.count += 10
+    sut.remove(loaded[0])
+    sut.append(Widget(name='new'))
+    fail_puts(s3_client, loaded[2].id)
+
+    with pytest.raises(ff.RepositoryError):
+        sut.commit()
+
+    assert stored(s3_client) == before
+
+
+def test_failed_index_update_is_rolled_back(sut, widgets, s3_client):
+    before = stored(s3_client)
+    loaded = sut.find_many([w.id for w in widgets])
+    for widget in loaded:
+        widget.count += 10
+    sut.append(Widget(name='new'))
+    fail_puts(s3_client, f'shard-{sut._shard(loaded[2].id):03d}')
+
+    with pytest.raises(ff.RepositoryError):
+        sut.commit()
+
+    assert stored(s3_client) == before
+
+
+def test_repeated_conflicts_give_up(repository, widgets, s3_client):
+    sut = repository(max_conflicts=2)
+    sut.find(widgets[0].id).count = 10
+    fail_puts(s3_client, widgets[0].id, code='PreconditionFailed')
+
+    with pytest.raises(ff.ConcurrentUpdateDetected):
+        sut.commit()
+    with pytest.raises(ff.RepositoryError) as e:
+        sut.commit()
+    assert not isinstance(e.value, ff.ConcurrentUpdateDetected)
+
+
+def test_aggregates_are_loaded_once(sut, widgets, s3_client):
+    ids = [w.id for w in widgets]
+    loaded = sut.find_many(ids + ['missing', ids[0]])
+    gets = s3_client.calls['get_object']
+
+    assert [w.id for w in loaded] == ids
+    assert sut.find(ids[1]) is loaded[1]
+    assert all(a is b for a, b in zip(sut.find_many(list(reversed(ids))), reversed(loaded)))
+    assert s3_client.calls['get_object'] == gets
+
+
+def test_reset_clears_the_identity_map(sut, widgets):
+    loaded = sut.find(widgets[0].id)
+    sut.reset()
+
+    assert sut.find(widgets[0].id) is not loaded
+
+
+def test_appended_aggregates_are_found_before_commit(sut):
+    widget = Widget(name='widget')
+    sut.append(widget)
+
+    assert sut.find(widget.id) is widget
+
+
+@pytest.mark.parametrize('codec', ['json', 'json+gzip', 'msgpack', 'msgpack+gzip', 'cbor', 'cbor+gzip'])
+def test_codecs_round_trip(codec, s3_client, logger):
+    fmt, _ = encoding.parse_codec(codec)
+    if fmt != encoding.JSON:
+        pytest.importorskip({encoding.MSGPACK: 'msgpack', encoding.CBOR: 'cbor2'}[fmt])
+    sut = Orders(s3_client, ffi.JsonSerializer(), 'bucket', codec=codec)
+    sut._logger = logger
+    order = Order(customer='ada', placed_at=datetime(2021, 6, 1, 12, 30), parts=[
+        Part(sku='ä-1', price=9.99, shipped_at=datetime(2021, 6, 2)), Part(sku='b-2', price=1.5),
+    ])
+    sut.append(order)
+    sut.commit()
+    sut.reset()
+
+    assert sut.find(order.id).to_dict() == order.to_dict()
+    assert ('bucket', f'object-store/aggregates/orders/{order.id}.{codec.replace("+gzip", ".gz")}') in s3_client.objects
+
+
+def test_aggregates_move_to_the_current_codec_when_saved(s3_client, logger):
+    writer = Orders(s3_client, ffi.JsonSerializer(), 'bucket')
+    writer._logger = logger
+    order = Order(customer='ada', placed_at=datetime(2021, 6, 1))
+    writer.append(order)
+    writer.commit()
+
+    sut = Orders(s3_client, ffi.JsonSerializer(), 'bucket', codec='json+gzip')
+    sut._logger = logger
+    sut.find(order.id).customer = 'grace'
+    sut.commit()
+    sut.reset()
+
+    assert sut.find(order.id).customer == 'grace'
+    assert [key for _, key in s3_client.objects if '/_index/' not in key] == [sut._key(order.id)]
+
+
+@pytest.fixture()
+def catalog(sut):
+    ret = [
+        Widget(name='a', count=2, created=datetime(2021, 1, 1), description='red'),
+        Widget(name='b', count=10, created=datetime(2021, 6, 1), description='blue'),
+        Widget(name='c', count=30, created=datetime(2021, 12, 1), description='red'),
+    ]
+    sut.append(ret)
+    sut.commit()
+    sut.reset()
+    return ret
+
+
+@pytest.mark.parametrize('criteria, names, loads', [
+    (lambda w: w.count > 9, ['b', 'c'], 2),
+    (lambda w: w.created < datetime(2021, 6, 1), ['a'], 1),
+    (lambda w: (w.name == 'a') | (w.count == 30), ['a', 'c'], 2),
+    # Unindexed clauses are checked on the loaded aggregates.
+    (lambda w: (w.count > 1) & (w.description == 'red'), ['a', 'c'], 3),
+    (lambda w: (w.count > 20) | (w.description == 'blue'), ['b', 'c'], 3),
+])
+def test_criteria_are_answered_from_the_index(sut, catalog, s3_client, criteria, names, loads):
+    gets = s3_client.calls['get_object']
+    ret = sut.filter(criteria)
+
+    assert sorted(w.name for w in ret) == names
+    assert s3_client.calls['get_object'] - gets - sut._index_shards == loads
+
+
+def test_index_select_casts_typed_fields(repository, catalog, s3_client, logger):
+    file_system = S3FileSystem()
+    file_system._s3_client = s3_client
+    file_system._logger = logger
+    sut = repository(use_select=True, file_system=file_system)
+    expressions = []
+    select_object_content = s3_client.select_object_content
+    s3_client.select_object_content = lambda **kwargs: expressions.append(kwargs['Expression']) or \
+        select_object_content(**kwargs)
+
+    assert sorted(w.name for w in sut.filter(lambda w: w.count > 9)) == ['b', 'c']
+    assert set(expressions) == {'select s."id" from s3object s where (CAST(s."count" AS INT) > 9)'}
+
+
+def test_index_select_needs_a_file_system(repository):
+    with pytest.raises(ff.ConfigurationError):
+        repository(use_select=True)
+
+
+def test_concurrent_updates_are_detected(sut, repository):
+    widget = Widget(name='widget')
+    sut.append(widget)
+    sut.commit()
+
+    other = repository()
+    other.find(widget.id).count = 2
+    sut.find(widget.id).count = 1
+    sut.commit()
+
+    with pytest.raises(ff.ConcurrentUpdateDetected):
+        other.commit()
+
+    other.reset()
+    assert other.find(widget.id).count == 1
+
+
+def test_new_aggregates_do_not_overwrite_existing_ones(sut, repository):
+    widget = Widget(name='widget')
+    sut.append(widget)
+    sut.commit()
+
+    other = repository()
+    other.append(Widget(id=widget.id, name='impostor'))
+
+    with pytest.raises(ff.ConcurrentUpdateDetected):
+        other.commit()
+
+
+def test_unconditional_writes_overwrite(sut, repository):
+    widget = Widget(name='widget')
+    sut.append(widget)
+    sut.commit()
+
+    other = repository(conditional_writes=False)
+    other.find(widget.id).count = 2
+    sut.find(widget.id).count = 1
+    sut.commit()
+    other.commit()
+
+    sut.reset()
+    assert sut.find(widget.id).count == 2
+
+
+def test_index_shards_are_written_conditionally_without_conditional_writes(repository, s3_client):
+    sut = repository(conditional_writes=False, index_shards=1)
+    other = repository(conditional_writes=False, index_shards=1)
+    sut.append(Widget(name='first'))
+    sut.commit()
+
+    get_object = s3_client.get_object
+
+    def _get_object(**kwargs):
+        ret = get_object(**kwargs)
+        if '/_index/' in kwargs['Key']:
+            # Another writer updates the shard between this read and the write.
+            s3_client.get_object = get_object
+            other.append(Widget(name='other'))
+            other.commit()
+        return ret
+
+    s3_client.get_object = _get_object
+    sut.append(Widget(name='second'))
+    sut.commit()
+
+    sut.reset()
+    assert sorted(w.name for w in sut) == ['first', 'other', 'second']
+
+
+def test_preconditions_are_sent_as_headers_when_botocore_does_not_model_them(logger):
+    client = boto3.client('s3', region_name='us-east-1', aws_access_key_id='key', aws_secret_access_key='secret')
+    model = client.meta.service_model.operation_model('PutObject').input_shape.members
+    if 'IfMatch' in model:
+        pytest.skip('botocore supports conditional writes natively')
+
+    headers = []
+
+    class Raw:
+        def stream(self, **kwargs):
+            return iter([b''])
+
+    def send(request, **kwargs):
+        headers.append({k: v for k, v in request.headers.items() if k.startswith('If-')})
+        return AWSResponse(request.url, 200, {'ETag': '"1"'}, Raw())
+
+    client.meta.events.register('before-send.s3', send)
+    sut = Widgets(client, ffi.JsonSerializer(), 'bucket')
+    sut._logger = logger
+    widget = Widget(name='widget')
+    sut._put(widget)
+    sut._put(widget)
+
+    assert headers == [{'If-None-Match': b'*'}, {'If-Match': b'"1"'}]
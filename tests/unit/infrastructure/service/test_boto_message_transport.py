@@ -0,0 +1,311 @@
+import io
+import json
+import threading
+
+import botocore.session
+import firefly as ff
+import firefly.infrastructure as ffi
+import pytest
+from botocore.exceptions import ClientError
+from botocore.stub import Stubber, ANY
+from firefly_aws.infrastructure import BotoMessageTransport
+
+
+class WidgetCreated(ff.Event):
+    _context = 'widgets'
+
+
+class CreateWidget(ff.Command):
+    _context = 'widgets'
+
+
+class GetWidget(ff.Query):
+    _context = 'widgets'
+
+
+class StubLambdaClient:
+    def __init__(self, error_code: str = None):
+        self.error_code = error_code
+        self.invoke_calls = []
+
+    def invoke(self, **kwargs):
+        self.invoke_calls.append(kwargs)
+        if self.error_code is not None:
+            raise ClientError({'Error': {'Code': self.error_code, 'Message': ''}}, 'Invoke')
+        payload = json.loads(kwargs['Payload'])
+        return {'Payload': io.BytesIO(json.dumps(payload['headers'].get('n')).encode('utf-8'))}
+
+
+class StubContextMap:
+    def __init__(self, contexts: list):
+        self.contexts = contexts
+
+    def get_context(self, name: str):
+        return name if name in self.contexts else None
+
+
+class StubCommandResolver:
+    def __init__(self, handlers: dict):
+        self.handlers = handlers
+
+    def has_command_handler(self, handler: str):
+        return handler in self.handlers
+
+    def __call__(self, message, next_):
+        return self.handlers[str(message)](message)
+
+
+class StubKernel:
+    """
+    Stands in for the system bus: records the messages sent through the middleware stack before resolving them.
+    """
+
+    def __init__(self, command_resolver: StubCommandResolver):
+        self.command_resolver = command_resolver
+        self.messages = []
+        self.threads = set()
+
+    def invoke(self, command):
+        self.messages.append(command)
+        self.threads.add(threading.get_ident())
+        return self.command_resolver(command, lambda m: None)
+
+
+class StubSqsClient:
+    def __init__(self):
+        self.get_queue_url_calls = 0
+        self.send_message_batch_calls = []
+        self.send_message_calls = []
+
+    def get_queue_url(self, QueueName: str):
+        self.get_queue_url_calls += 1
+        return {'QueueUrl': f'https://sqs.local/{QueueName}'}
+
+    def send_message(self, **kwargs):
+        self.send_message_calls.append(kwargs)
+
+    def send_message_batch(self, QueueUrl: str, Entries: list):
+        self.send_message_batch_calls.append((QueueUrl, Entries))
+        return {'Successful': [{'Id': e['Id']} for e in Entries], 'Failed': []}
+
+
+class StubSnsClient:
+    def __init__(self, failures: dict = None):
+        self.failures = failures or {}
+        self.publish_calls = []
+        self.publish_batch_calls = []
+
+    def publish(self, **kwargs):
+        self.publish_calls.append(kwargs)
+
+    def publish_batch(self, TopicArn: str, PublishBatchRequestEntries: list):
+        self.publish_batch_calls.append(PublishBatchRequestEntries)
+        failed = []
+        for entry in PublishBatchRequestEntries:
+            if self.failures.get(entry['Message'], 0) > 0:
+                self.failures[entry['Message']] -= 1
+                failed.append(entry['Id'])
+
+        return {
+            'Successful': [{'Id': e['Id']} for e in PublishBatchRequestEntries if e['Id'] not in failed],
+            'Failed': [{'Id': id_, 'Code': 'InternalError', 'SenderFault': False} for id_ in failed],
+        }
+
+
+@pytest.fixture()
+def sut():
+    ret = BotoMessageTransport()
+    ret._serializer = ffi.JsonSerializer()
+    ret._store_large_payloads_in_s3 = lambda payload: payload
+    ret._sns_client = StubSnsClient()
+    ret._sqs_client = StubSqsClient()
+    ret._lambda_client = StubLambdaClient()
+    ret._project = 'firefly'
+    ret._ff_environment = 'test'
+    ret._region = 'us-east-1'
+    ret._account_id = '123456789012'
+
+    return ret
+
+
+def test_events_are_published_immediately_outside_a_unit_of_work(sut):
+    sut.dispatch(WidgetCreated())
+
+    assert len(sut._sns_client.publish_calls) == 1
+    assert len(sut._sns_client.publish_batch_calls) == 0
+
+
+def test_events_are_batched_until_flush(sut):
+    sut.begin()
+    for _ in range(50):
+        sut.dispatch(WidgetCreated())
+
+    assert len(sut._sns_client.publish_batch_calls) == 0
+
+    sut.flush()
+
+    assert len(sut._sns_client.publish_calls) == 0
+    assert len(sut._sns_client.publish_batch_calls) == 5
+    assert all(len(entries) == 10 for entries in sut._sns_client.publish_batch_calls)
+
+
+@pytest.fixture()
+def sns_client():
+    return botocore.session.get_session().create_client(
+        'sns', region_name='us-east-1', aws_access_key_id='x', aws_secret_access_key='x'
+    )
+
+
+def test_flush_matches_the_sns_client_model(sut, sns_client):
+    sut._sns_client = sns_client
+    topic_arn = sut._topic_arn('widgets')
+
+    with Stubber(sns_client) as stubber:
+        if hasattr(sns_client, 'publish_batch'):
+            stubber.add_response('publish_batch', {'Successful': [], 'Failed': []}, {
+                'TopicArn': topic_arn, 'PublishBatchRequestEntries': ANY,
+            })
+        else:
+            for _ in range(2):
+                stubber.add_response('publish', {'MessageId': '1'}, {
+                    'TopicArn': topic_arn, 'Message': ANY, 'MessageAttributes': ANY,
+                })
+
+        sut.begin()
+        sut.dispatch(WidgetCreated())
+        sut.dispatch(WidgetCreated())
+        sut.flush()
+
+        stubber.assert_no_pending_responses()
+
+
+def test_events_are_published_one_at_a_time_without_publish_batch(sut, sns_client, monkeypatch):
+    # botocore before 1.23 has no PublishBatch
+    monkeypatch.delattr(type(sns_client), 'publish_batch', raising=False)
+    sut._sns_client = sns_client
+    topic_arn = sut._topic_arn('widgets')
+
+    with Stubber(sns_client) as stubber:
+        stubber.add_response('publish', {'MessageId': '1'}, {
+            'TopicArn': topic_arn, 'Message': ANY, 'MessageAttributes': ANY,
+        })
+        stubber.add_client_error('publish', 'Throttled', http_status_code=400)
+        stubber.add_response('publish', {'MessageId': '2'}, {
+            'TopicArn': topic_arn, 'Message': ANY, 'MessageAttributes': ANY,
+        })
+
+        sut.begin()
+        sut.dispatch(WidgetCreated())
+        sut.dispatch(WidgetCreated())
+        sut.flush()
+
+        stubber.assert_no_pending_responses()
+
+
+def test_only_failed_entries_are_retried(sut):
+    event = WidgetCreated()
+    sut._sns_client.failures = {sut._serializer.serialize(event): 1}
+
+    sut.begin()
+    sut.dispatch(event)
+    for _ in range(9):
+        sut.dispatch(WidgetCreated())
+    sut.flush()
+
+    assert len(sut._sns_client.publish_batch_calls) == 2
+    assert len(sut._sns_client.publish_batch_calls[1]) == 1
+
+
+def test_batches_are_limited_by_bytes(sut):
+    # 40,000 characters, but 120,000 bytes in UTF-8
+    entry = {'MessageBody': '€' * 40000, 'MessageAttributes': {
+        '_name': {'DataType': 'String', 'StringValue': 'ä' * 100},
+    }}
+
+    assert sut._entry_size(entry, 'MessageBody') == 120000 + len('_name') + len('String') + 200
+    assert [len(batch) for batch in sut._batch([entry] * 5, 'MessageBody')] == [2, 2, 1]
+
+
+def test_discarded_events_are_not_published(sut):
+    sut.begin()
+    sut.dispatch(WidgetCreated())
+    sut.discard()
+    sut.flush()
+
+    assert len(sut._sns_client.publish_calls) == 0
+    assert len(sut._sns_client.publish_batch_calls) == 0
+
+
+def test_async_commands_are_batched_without_queue_lookups(sut):
+    sut.begin()
+    for _ in range(15):
+        command = CreateWidget()
+        command._async = True
+        sut.invoke(command)
+    sut.flush()
+
+    assert sut._sqs_client.get_queue_url_calls == 0
+    assert [len(entries) for _, entries in sut._sqs_client.send_message_batch_calls] == [10, 5]
+    assert sut._sqs_client.send_message_batch_calls[0][0] == \
+        'https://sqs.us-east-1.amazonaws.com/123456789012/FireflyTestWidgetsQueue'
+
+
+def test_fan_out_returns_results_in_order(sut):
+    queries = [GetWidget(headers={'n': i}) for i in range(20)]
+
+    assert sut.request_many(queries) == list(range(20))
+    assert len(sut._lambda_client.invoke_calls) == 20
+
+
+def test_fire_and_forget_commands_use_event_invocations(sut):
+    assert sut.invoke(CreateWidget(headers={'fire_and_forget': True})) is None
+    assert sut._lambda_client.invoke_calls[0]['InvocationType'] == 'Event'
+
+
+def test_non_retryable_lambda_errors_fail_fast(sut):
+    sut._lambda_client.error_code = 'ResourceNotFoundException'
+
+    with pytest.raises(ff.MessageBusError):
+        sut.invoke(CreateWidget())
+    assert len(sut._lambda_client.invoke_calls) == 1
+
+    assert isinstance(sut.request_many([GetWidget()], return_exceptions=True)[0], ff.MessageBusError)
+
+
+def test_single_messages_are_always_sent_over_the_network(sut):
+    # The resolving middleware only hands the transport messages for other functions.
+    sut._context_map = StubContextMap(['widgets'])
+    sut._command_resolver = StubCommandResolver({str(CreateWidget()): lambda message: 'handled'})
+    sut._kernel = StubKernel(sut._command_resolver)
+
+    sut.invoke(CreateWidget(headers={'n': 1}))
+    assert sut._kernel.messages == []
+    assert len(sut._lambda_client.invoke_calls) == 1
+
+
+def test_locally_handled_messages_in_a_fan_out_are_not_sent_over_the_network(sut):
+    sut._context_map = StubContextMap(['widgets'])
+    sut._command_resolver = StubCommandResolver({str(CreateWidget()): lambda message: 'handled'})
+    sut._kernel = StubKernel(sut._command_resolver)
+
+    command = CreateWidget()
+    assert sut.invoke_many([command]) == ['handled']
+    assert sut._kernel.messages == [command]
+    assert len(sut._lambda_client.invoke_calls) == 0
+
+    command = CreateWidget()
+    command._async = True
+    sut.invoke_many([command])
+    assert len(sut._sqs_client.send_message_calls) == 1
+
+
+def test_local_fan_out_runs_sequentially_on_the_calling_thread(sut):
+    sut._context_map = StubContextMap(['widgets'])
+    sut._command_resolver = StubCommandResolver({str(CreateWidget()): lambda message: message.headers['n']})
+    sut._kernel = StubKernel(sut._command_resolver)
+    commands = [CreateWidget(headers={'n': i}) for i in range(5)]
+    commands.insert(2, CreateWidget(headers={'n': 'remote', 'fire_and_forget': True}))
+
+    assert sut.invoke_many(commands) == [0, 1, None, 2, 3, 4]
+    assert sut._kernel.threads == {threading.get_ident()}
+    assert len(sut._lambda_client.invoke_calls) == 1
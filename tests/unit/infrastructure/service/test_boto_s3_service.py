@@ -0,0 +1,31 @@
+import os
+
+from firefly_aws.infrastructure import BotoS3Service
+
+MB = 1024 * 1024
+
+
+def test_part_size_and_concurrency_are_configurable(s3_client, logger):
+    sut = BotoS3Service()
+    sut._s3_client = s3_client
+    sut._logger = logger
+    sut._bucket = 'bucket'
+    sut._s3_part_size = str(6 * MB)
+    sut._s3_upload_concurrency = '2'
+    data = os.urandom(15 * MB)
+
+    sut.store_download(data, file_name='export', apply_compression=False)
+
+    assert s3_client.calls['upload_part'] == 3
+    assert s3_client.body('bucket', '/tmp/export') == data
+
+
+def test_defaults_are_used_when_not_configured(s3_client, logger):
+    sut = BotoS3Service()
+    sut._s3_client = s3_client
+    sut._logger = logger
+    sut._bucket = 'bucket'
+
+    sut.store_download(os.urandom(15 * MB), file_name='export', apply_compression=False)
+
+    assert s3_client.calls['upload_part'] == 2
@@ -0,0 +1,65 @@
+import json
+
+import pytest
+from botocore.exceptions import ClientError
+from firefly_aws.infrastructure import S3FileSystem
+
+
+@pytest.fixture()
+def records():
+    return [{'id': i, 'name': f'wïdget {i}'} for i in range(10)]
+
+
+@pytest.fixture()
+def sut(records, s3_client, logger):
+    stream = b''.join(json.dumps(r, ensure_ascii=False).encode('utf-8') + b'\n' for r in records)
+    s3_client.put_object(Bucket='bucket', Key='widgets.jsonl', Body=stream)
+    # Split records, and multi-byte characters, across chunk boundaries.
+    s3_client.select_chunk_size = 7
+    ret = S3FileSystem()
+    ret._s3_client = s3_client
+    ret._logger = logger
+    return ret
+
+
+def test_records_split_across_chunks_are_reassembled(sut, records):
+    assert list(sut.iter_filter('bucket/widgets.jsonl', ['*'], None)) == records
+
+
+def test_records_are_batched(sut, records):
+    assert list(sut.iter_filter('bucket/widgets.jsonl', ['*'], None, batch_size=4)) == \
+        [records[0:4], records[4:8], records[8:10]]
+
+
+def test_filter_returns_a_json_array(sut, records):
+    assert json.loads(sut.filter('bucket/widgets.jsonl', ['*'], None)) == records
+
+
+def test_select_errors_are_logged_by_filter_and_raised_by_iter_filter(sut):
+    assert sut.filter('bucket/missing.jsonl', ['*'], None) == ''
+    with pytest.raises(ClientError):
+        list(sut.iter_filter('bucket/missing.jsonl', ['*'], None))
+
+
+def test_only_large_json_lines_objects_are_split_into_scan_ranges(sut):
+    assert sut._scan_ranges('bucket/data.jsonl', 250, 100) == [
+        {'Start': 0, 'End': 99}, {'Start': 100, 'End': 199}, {'Start': 200, 'End': 249}
+    ]
+    assert sut._scan_ranges('bucket/data.jsonl', 100, 100) == [None]
+    assert sut._scan_ranges('bucket/data.csv', 250, 100) == [None]
+    assert sut._scan_ranges('bucket/data.jsonl.gz', 250, 100) == [None]
+
+
+def test_warm_reads_are_served_from_the_disk_cache(sut, s3_client, tmp_path):
+    s3_client.put_object(Bucket='bucket', Key='rates.json', Body=b'{"rate": 1}')
+    sut._s3_cache_size = '1048576'
+    sut._s3_cache_dir = str(tmp_path)
+
+    assert sut.read('bucket/rates.json').content == '{"rate": 1}'
+    assert sut.read('bucket/rates.json').content == '{"rate": 1}'
+    # The warm read only revalidates the ETag.
+    assert s3_client.calls['get_object'] == 2
+
+    s3_client.put_object(Bucket='bucket', Key='rates.json', Body=b'{"rate": 2}')
+    assert sut.read('bucket/rates.json').content == '{"rate": 2}'
+    assert sut.cache_stats()['hit_ratio'] == pytest.approx(1 / 3)
@@ -0,0 +1,73 @@
+from datetime import datetime
+
+import firefly as ff
+import pytest
+from firefly_aws.infrastructure import S3SelectCompiler
+from firefly_aws.infrastructure.service import s3_select_compiler
+
+
+@pytest.fixture()
+def sut():
+    return S3SelectCompiler()
+
+
+def test_values_are_escaped(sut):
+    assert sut.compile(['*'], ff.Attr('name') == "O'Brien") == \
+        """select * from s3object s where (s."name" = 'O''Brien')"""
+
+
+def test_parameters_that_prefix_each_other_are_not_confused(sut):
+    criteria = (ff.Attr('a') == 1) & (ff.Attr('b') == 2) & (ff.Attr('c') == 3) & (ff.Attr('d') == 4) & \
+        (ff.Attr('e') == 5) & (ff.Attr('f') == 6) & (ff.Attr('g') == 7) & (ff.Attr('h') == 8) & \
+        (ff.Attr('i') == 9) & (ff.Attr('j') == 10)
+
+    sql = sut.compile(['*'], criteria)
+
+    assert '(s."a" = 1)' in sql
+    assert '(s."j" = 10)' in sql
+
+
+def test_fields_are_projected(sut):
+    assert sut.compile(['id', 'address.city']) == 'select s."id", s."address"."city" from s3object s'
+
+
+def test_expressions_are_projected_as_written(sut):
+    assert sut.compile(['s.id', 'count(*)', 'CAST(s.total AS FLOAT)', 'name']) == \
+        'select s.id, count(*), CAST(s.total AS FLOAT), s."name" from s3object s'
+
+
+def test_like_patterns_are_escaped(sut):
+    assert sut.compile(['*'], ff.Attr('name').contains('50%_off')) == \
+        """select * from s3object s where (s."name" LIKE '%50\\%\\_off%' ESCAPE '\\')"""
+
+
+def test_other_operators(sut):
+    criteria = ff.Attr('tag').is_in(['a', 'b']) | ff.Attr('deleted').is_none() | \
+        (ff.Attr('created') >= datetime(2021, 6, 1))
+
+    assert sut.compile(['*'], criteria) == 'select * from s3object s where ' \
+        """(((s."tag" IN ('a', 'b')) OR (s."deleted" IS NULL)) """ \
+        """OR (s."created" >= CAST('2021-06-01T00:00:00' AS TIMESTAMP)))"""
+
+
+def test_empty_lists_match_nothing(sut):
+    criteria = ff.Attr('tag').is_in([]) | (ff.Attr('name') == 'a')
+
+    assert sut.compile(['*'], criteria) == """select * from s3object s where ((1 = 0) OR (s."name" = 'a'))"""
+
+
+def test_templates_are_reused_for_criteria_of_the_same_shape(sut):
+    s3_select_compiler._template.cache_clear()
+
+    assert sut.compile(['*'], ff.Attr('name') == 'a') != sut.compile(['*'], ff.Attr('name') == 'b')
+    assert sut.compile(['*'], ff.Attr('name') == 'b') == """select * from s3object s where (s."name" = 'b')"""
+    info = s3_select_compiler._template.cache_info()
+    assert (info.misses, info.hits) == (1, 2)
+
+
+def test_typed_fields_are_cast(sut):
+    criteria = (ff.Attr('created') >= datetime(2021, 6, 1)) & (ff.Attr('count') > 9) & (ff.Attr('name') == 'a')
+
+    assert sut.compile(['id'], criteria, types={'created': 'TIMESTAMP', 'count': 'INT'}) == \
+        'select s."id" from s3object s where (((CAST(s."created" AS TIMESTAMP) >= ' \
+        """CAST('2021-06-01T00:00:00' AS TIMESTAMP)) AND (CAST(s."count" AS INT) > 9)) AND (s."name" = 'a'))"""